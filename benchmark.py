@@ -0,0 +1,480 @@
+"""
+Benchmarks for servermod.py against a local stand-in for the Server Mods API.
+
+The stand-in implements /projects and /files as described in apiary.apib and
+serves synthetic JARs, with configurable latency, bandwidth and JAR size. Each
+scenario is run at several scales and reports wall time, requests issued,
+bytes transferred and peak memory:
+
+    python benchmark.py --scales 10,100,1000 --latency 0.005 --json out.json
+
+It also times how long a fresh interpreter takes to import servermod and parse
+a command line, and fails if that goes over --startup-budget or drags in any
+of the modules which should only be imported once they're needed.
+"""
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:  # Python 2
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import servermod
+
+
+class MockServerModsAPI(ThreadingMixIn, HTTPServer):
+    """ Serves `projects` fake server mods, each with `files_per_project`
+    files, the newest of which is at `version`. Bump `version` to make
+    every project look like it has an update. """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, projects=10, files_per_project=5, jar_size=64 * 1024,
+                 latency=0.0, bandwidth=0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), MockRequestHandler)
+        self.projects = projects
+        self.files_per_project = files_per_project
+        self.jar_size = jar_size
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second, 0 for unlimited
+        self.version = 0
+        self.lock = threading.Lock()
+        self.reset_counters()
+
+    @property
+    def root_url(self):
+        return 'http://{0}:{1}'.format(*self.server_address)
+
+    @property
+    def base_url(self):
+        return self.root_url + '/servermods/'
+
+    def reset_counters(self):
+        with self.lock:
+            self.requests = 0
+            self.connections = 0
+            self.bytes_sent = 0
+
+    def count_connection(self):
+        with self.lock:
+            self.connections += 1
+
+    def count(self, n_bytes):
+        with self.lock:
+            self.requests += 1
+            self.bytes_sent += n_bytes
+
+    def slug(self, project_id):
+        return 'plugin{0}'.format(project_id)
+
+    def project_json(self, project_id):
+        return {
+            'id': project_id,
+            'name': 'Plugin {0}'.format(project_id),
+            'slug': self.slug(project_id),
+            'stage': 'release'
+        }
+
+    def files_json(self, project_id):
+        files = []
+        newest = self.version + self.files_per_project
+        for n in range(newest - self.files_per_project + 1, newest + 1):
+            files.append({
+                'downloadUrl': '{0}/jars/{1}/{2}.jar'.format(
+                    self.root_url, project_id, n
+                ),
+                'fileName': '{0}-{1}.jar'.format(self.slug(project_id), n),
+                'gameVersion': 'CB 1.{0}'.format(n),
+                'name': 'Plugin {0} v{1}'.format(project_id, n),
+                'projectId': project_id,
+                'releaseType': 'release'
+            })
+        return files
+
+    def jar(self, project_id, n):
+        header = 'PK fake jar {0} {1}\n'.format(project_id, n).encode('ascii')
+        return header + b'\0' * max(0, self.jar_size - len(header))
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class MockRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True  # or keep-alive adds 40ms per request
+
+    def log_message(self, *args):
+        pass
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        self.server.count_connection()
+
+    def do_GET(self):
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+
+        url = urlparse(self.path)
+        path = '/' + '/'.join(p for p in url.path.split('/') if p)
+        query = parse_qs(url.query)
+
+        if path == '/servermods/projects':
+            search = query.get('search', [''])[0]
+            body = [
+                server.project_json(i) for i in range(server.projects)
+                if search in server.slug(i)
+            ]
+            return self.send_json(body)
+
+        if path == '/servermods/files':
+            body = []
+            for project_id in query.get('projectIds', [''])[0].split(','):
+                if project_id.isdigit() and \
+                        int(project_id) < server.projects:
+                    body.extend(server.files_json(int(project_id)))
+            return self.send_json(body)
+
+        if path.startswith('/jars/'):
+            _, _, project_id, n = path.split('/')
+            return self.send_body(
+                server.jar(int(project_id), int(n.split('.')[0])),
+                'application/java-archive'
+            )
+
+        self.send_json({'errorCode': 404, 'errorMessage': 'Not Found'}, 404)
+
+    def send_json(self, obj, status=200):
+        self.send_body(
+            json.dumps(obj).encode('utf-8'),
+            'application/json; charset=utf-8', status
+        )
+
+    def send_body(self, body, content_type, status=200):
+        self.server.count(len(body))
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        bandwidth = self.server.bandwidth
+        chunk_size = 64 * 1024
+        if bandwidth:
+            chunk_size = max(1, min(chunk_size, bandwidth // 10))
+        for i in range(0, len(body), chunk_size):
+            chunk = body[i:i + chunk_size]
+            self.wfile.write(chunk)
+            if bandwidth:
+                time.sleep(float(len(chunk)) / bandwidth)
+
+
+class BenchmarkClient(servermod.CommandLineClient):
+    """ Command line client which never asks questions or draws progress """
+
+    def await_ok(self):
+        return True
+
+    def print_status(self, msg):
+        pass
+
+
+class Measurement(object):
+    """ Context manager recording wall time, requests, bytes and peak
+    memory (tracemalloc where available, otherwise max RSS) """
+
+    def __init__(self, server, trace_memory=True):
+        self.server = server
+        self.trace_memory = trace_memory
+        self.result = {}
+
+    def __enter__(self):
+        self.tracemalloc = None
+        if self.trace_memory:
+            try:
+                import tracemalloc
+                tracemalloc.start()
+                self.tracemalloc = tracemalloc
+            except ImportError:
+                pass
+        self.server.reset_counters()
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.result['wall_time'] = time.time() - self.start
+        self.result['requests'] = self.server.requests
+        self.result['connections'] = self.server.connections
+        self.result['bytes'] = self.server.bytes_sent
+        if self.tracemalloc is not None:
+            self.result['peak_memory'] = \
+                self.tracemalloc.get_traced_memory()[1]
+            self.tracemalloc.stop()
+        else:
+            try:
+                import resource
+                # kilobytes on Linux, and for the whole process
+                self.result['peak_memory'] = resource.getrusage(
+                    resource.RUSAGE_SELF
+                ).ru_maxrss * 1024
+            except ImportError:
+                self.result['peak_memory'] = None
+
+
+class quiet(object):
+    """ Swallows stdout for the duration """
+
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *exc_info):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def scenario_api_projects(server, scale, options):
+    api = servermod.ServerModAPI('benchmark')
+    api.base_url = server.base_url
+    with Measurement(server, options.memory) as m:
+        for i in range(scale):
+            api.projects(server.slug(i))
+    return m.result
+
+
+def scenario_api_files(server, scale, options):
+    api = servermod.ServerModAPI('benchmark', jobs=options.jobs)
+    api.base_url = server.base_url
+    with Measurement(server, options.memory) as m:
+        api.files(project_ids=range(scale))
+    return m.result
+
+
+def client_args(plugins_dir, options, *args):
+    return [
+        '--plugins-dir', plugins_dir, '--api-key', 'benchmark',
+        '--jobs', str(options.jobs),
+        # keep the slug index out of the user's own cache
+        '--cache-dir', os.path.join(plugins_dir, '.servermods-cache')
+    ] + list(args)
+
+
+def scenario_install(server, scale, options, plugins_dir):
+    slugs = [server.slug(i) for i in range(scale)]
+    with Measurement(server, options.memory) as m:
+        with quiet():
+            BenchmarkClient().run(
+                client_args(plugins_dir, options, 'install', '--yes', *slugs)
+            )
+    return m.result
+
+
+def scenario_update(server, scale, options, plugins_dir):
+    server.version += 1
+    with Measurement(server, options.memory) as m:
+        with quiet():
+            BenchmarkClient().run(client_args(plugins_dir, options, 'update'))
+    return m.result
+
+
+def scenario_recheck(server, scale, options, plugins_dir):
+    # rename every other JAR, and make the storage forget what it hashed
+    storage = servermod.CLIStorage(plugins_dir, jobs=options.jobs)
+    for data in list(storage.get_data().values())[::2]:
+        renamed = 'renamed-' + data['filename']
+        os.rename(
+            os.path.join(plugins_dir, data['filename']),
+            os.path.join(plugins_dir, renamed)
+        )
+    storage.data.pop('hash_index', None)
+    storage.save()
+
+    with Measurement(server, options.memory) as m:
+        servermod.CLIStorage(plugins_dir, jobs=options.jobs).recheck()
+    return m.result
+
+
+def run_scale(scale, options):
+    server = MockServerModsAPI(
+        projects=scale, files_per_project=options.files_per_project,
+        jar_size=options.jar_size, latency=options.latency,
+        bandwidth=options.bandwidth
+    ).start()
+    old_base_url = servermod.ServerModAPI.base_url
+    servermod.ServerModAPI.base_url = server.base_url
+    plugins_dir = tempfile.mkdtemp(prefix='servermod-benchmark-')
+    results = []
+    try:
+        for name, scenario in [
+                ('api.projects', scenario_api_projects),
+                ('api.files', scenario_api_files)]:
+            results.append((name, scenario(server, scale, options)))
+        for name, scenario in [
+                ('install', scenario_install),
+                ('update', scenario_update),
+                ('recheck', scenario_recheck)]:
+            results.append((name, scenario(
+                server, scale, options, plugins_dir
+            )))
+    finally:
+        servermod.ServerModAPI.base_url = old_base_url
+        shutil.rmtree(plugins_dir)
+        server.shutdown()
+        server.server_close()
+    return results
+
+
+# modules which are slow to import, and only needed once a request is made
+LAZY_MODULES = ['requests', 'urllib3', 'hashlib', 'subprocess']
+
+STARTUP_SCRIPT = """
+import sys
+import servermod
+client = servermod.CommandLineClient()
+sys.stdout.write(','.join(m for m in {0!r} if m in sys.modules))
+"""
+
+
+def measure_startup(runs):
+    """ Best wall time, over runs fresh interpreters, of importing servermod
+    and building its client on top of starting Python at all. Also returns
+    which LAZY_MODULES ended up imported. """
+    import subprocess
+    here = os.path.dirname(os.path.abspath(__file__))
+    script = STARTUP_SCRIPT.format(LAZY_MODULES)
+
+    def best(code):
+        fastest = None
+        output = None
+        for i in range(runs):
+            start = time.time()
+            output = subprocess.check_output([sys.executable, '-c', code],
+                                             cwd=here)
+            elapsed = time.time() - start
+            if fastest is None or elapsed < fastest:
+                fastest = elapsed
+        return fastest, output
+
+    bare, _ = best('pass')
+    loaded, imported = best(script)
+    imported = imported.decode('ascii')
+    return {
+        'wall_time': max(0.0, loaded - bare),
+        'imported': imported.split(',') if imported else []
+    }
+
+
+def format_bytes(n):
+    if n is None:
+        return '-'
+    for unit in ['B', 'KiB', 'MiB']:
+        if n < 1024:
+            return '{0:.0f} {1}'.format(n, unit)
+        n /= 1024.0
+    return '{0:.1f} GiB'.format(n)
+
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description=__doc__.strip().split(
+        '\n'
+    )[0])
+    parser.add_argument(
+        '--scales', default='10,100,1000',
+        help='comma separated numbers of plugins (default: 10,100,1000)'
+    )
+    parser.add_argument(
+        '--latency', type=float, default=0.0,
+        help='seconds the server waits before each response'
+    )
+    parser.add_argument(
+        '--bandwidth', type=int, default=0,
+        help='bytes per second per response, 0 for unlimited'
+    )
+    parser.add_argument(
+        '--jar-size', type=int, default=64 * 1024,
+        help='size of each synthetic JAR in bytes'
+    )
+    parser.add_argument(
+        '--files-per-project', type=int, default=5,
+        help='number of files listed for each project'
+    )
+    parser.add_argument(
+        '--jobs', '-j', type=int,
+        default=servermod.CommandLineClient.DEFAULT_JOBS,
+        help='--jobs to run the client with'
+    )
+    parser.add_argument(
+        '--no-memory', action='store_false', dest='memory',
+        help='don\'t trace peak memory (tracing slows things down)'
+    )
+    parser.add_argument(
+        '--json', help='also write the results to this file', nargs='?'
+    )
+    parser.add_argument(
+        '--startup-runs', type=int, default=10,
+        help='how many interpreters to time startup over (default: 10)'
+    )
+    parser.add_argument(
+        '--startup-budget', type=float, default=0.1,
+        help='most seconds importing servermod may add to startup ' +
+        '(default: 0.1)'
+    )
+    options = parser.parse_args(argv)
+
+    startup = measure_startup(options.startup_runs)
+    print('startup: {0:.3f}s over the bare interpreter (budget {1:.3f}s)'
+          .format(startup['wall_time'], options.startup_budget))
+    problems = []
+    if startup['wall_time'] > options.startup_budget:
+        problems.append('startup went over budget')
+    if startup['imported']:
+        problems.append('startup imported ' + ', '.join(startup['imported']))
+
+    all_results = []
+    row = '{0:>6} {1:<14} {2:>10} {3:>9} {4:>11} {5:>11} {6:>11}'
+    print(row.format(
+        'scale', 'scenario', 'wall time', 'requests', 'connections',
+        'transferred', 'peak memory'
+    ))
+    for scale in [int(z) for z in options.scales.split(',')]:
+        for name, result in run_scale(scale, options):
+            print(row.format(
+                scale, name, '{0:.3f}s'.format(result['wall_time']),
+                result['requests'], result['connections'],
+                format_bytes(result['bytes']),
+                format_bytes(result['peak_memory'])
+            ))
+            result.update({'scale': scale, 'scenario': name})
+            all_results.append(result)
+
+    startup.update({'scale': None, 'scenario': 'startup',
+                    'budget': options.startup_budget})
+    all_results.append(startup)
+    if options.json is not None:
+        with open(options.json, 'w') as f:
+            json.dump(all_results, f, indent=2)
+
+    for problem in problems:
+        sys.stderr.write(problem + '\n')
+    return 1 if problems else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
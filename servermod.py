@@ -1,5 +1,3 @@
-import requests
-
 try:
     import json
 except ImportError:
@@ -12,24 +10,373 @@ except ImportError:
 
 import os.path
 import os
+import stat
+import sys
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue  # Python 2
 
 
 def py3():
     """ This actually returns if you're NOT running Python 2 """
-    import platform
-    return not platform.python_version().startswith('2')
+    return sys.version_info[0] > 2
+
+
+def replace_file(src, dst):
+    """ Atomically moves src over dst, even on Windows where we can """
+    if hasattr(os, 'replace'):
+        os.replace(src, dst)  # Python 3.3+
+    else:
+        if os.name == 'nt' and os.path.exists(dst):
+            os.remove(dst)
+        os.rename(src, dst)
+
+
+def primary_digest(digests):
+    """ Picks the strongest of a dict of hashlib algorithm -> hex digest,
+    returned as "algorithm:digest" """
+    for algorithm, digest in sorted(digests.items()):
+        if algorithm != 'md5':
+            return algorithm + ':' + digest
+    return 'md5:' + digests['md5']
+
+
+def link_or_copy(src, dst, method='auto'):
+    """ Puts the contents of src at dst (which mustn't exist yet) by
+    hardlinking, reflinking or copying it. 'auto' tries them in that
+    order. Returns the method that worked. """
+    import shutil
+    methods = ['hardlink', 'reflink', 'copy'] if method == 'auto' else [method]
+    error = None
+    for method in methods:
+        try:
+            if method == 'hardlink':
+                os.link(src, dst)
+            elif method == 'reflink':
+                import fcntl
+                FICLONE = 0x40049409  # from linux/fs.h
+                with open(src, 'rb') as s:
+                    with open(dst, 'wb') as d:
+                        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+            elif method == 'copy':
+                shutil.copyfile(src, dst)
+            else:
+                raise ValueError("Unknown link method: " + method)
+            return method
+        except (OSError, IOError, ImportError) as e:
+            error = e
+            if method != 'hardlink' and os.path.exists(dst):
+                os.remove(dst)
+    raise error
+
+
+NUMBER_CHARS = frozenset('0123456789+-.eE')
+
+
+def iter_json_array(chunks):
+    """ Incrementally parses a JSON array out of an iterable of text chunks,
+    yielding each element as soon as it's complete, so that the whole
+    document never has to be in memory at once. Raises APIErrorException
+    if the document turns out to be an API error object instead. """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buf = ''
+    pos = 0
+    exhausted = False
+    state = 'start'  # then 'first', 'value', 'separator' and 'done'
+    while True:
+        while pos < len(buf) and buf[pos] in ' \t\r\n':
+            pos += 1
+
+        if pos == len(buf):
+            if exhausted:
+                if state == 'done':
+                    return
+                raise ValueError("Unexpected end of JSON array")
+            try:
+                buf = buf[pos:] + next(chunks)
+                pos = 0
+            except StopIteration:
+                exhausted = True
+            continue
+
+        if state == 'start':
+            if buf[pos] != '[':
+                data = json.loads(buf[pos:] + ''.join(chunks))
+                if isinstance(data, dict) and 'errorCode' in data:
+                    raise APIErrorException(data)
+                raise ValueError("Expected a JSON array")
+            pos += 1
+            state = 'first'
+        elif state == 'first' and buf[pos] == ']':
+            pos += 1
+            state = 'done'
+        elif state in ('first', 'value'):
+            try:
+                value, end = decoder.raw_decode(buf, pos)
+                # a number can be cut off at any '.', 'e' or digit, so one
+                # that runs up to the end of the buffer isn't finished yet
+                rest = end
+                if isinstance(value, (int, float)):
+                    while rest < len(buf) and buf[rest] in NUMBER_CHARS:
+                        rest += 1
+                incomplete = rest == len(buf) and not exhausted
+            except ValueError:
+                if exhausted:
+                    raise
+                incomplete = True
+            if incomplete:
+                # need more input (or, for a bare number, to be sure that
+                # there aren't any more digits to come)
+                try:
+                    buf = buf[pos:] + next(chunks)
+                    pos = 0
+                except StopIteration:
+                    exhausted = True
+                continue
+            pos = end
+            state = 'separator'
+            yield value
+        elif state == 'separator':
+            if buf[pos] == ',':
+                state = 'value'
+            elif buf[pos] == ']':
+                state = 'done'
+            else:
+                raise ValueError("Expected ',' or ']' in JSON array")
+            pos += 1
+        else:
+            raise ValueError("Extra data after JSON array")
+
+
+def place_file(src, dst, method='auto'):
+    """ Atomically replaces dst with the contents of src, see link_or_copy """
+    tmp_path = os.path.join(
+        os.path.dirname(dst), '.{0}.place.tmp'.format(os.path.basename(dst))
+    )
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    link_or_copy(src, tmp_path, method)
+    replace_file(tmp_path, dst)
+
+
+def fsync_dir(path):
+    """ Makes sure a rename inside path has hit the disk, where possible """
+    if os.name == 'nt':
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass  # not supported on every filesystem
+    finally:
+        os.close(fd)
+
+
+class FileLock(object):
+    """ Exclusive lock shared between threads and processes, used as a
+    context manager. On platforms without fcntl it only covers threads. """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.depth = 0
+        self.f = None
+
+    def __enter__(self):
+        self.lock.acquire()
+        self.depth += 1
+        if self.depth == 1:
+            self.f = open(self.path, 'a')
+            try:
+                import fcntl
+                fcntl.flock(self.f.fileno(), fcntl.LOCK_EX)
+            except ImportError:
+                pass  # Windows, we'll have to hope for the best
+        return self
+
+    def __exit__(self, *exc_info):
+        self.depth -= 1
+        if self.depth == 0:
+            self.f.close()  # releases the flock
+            self.f = None
+        self.lock.release()
+
+
+class WorkerPool(object):
+    """ Runs a function over a list of items on a bounded set of threads """
+
+    def __init__(self, jobs=1):
+        self.jobs = max(1, int(jobs))
+
+    def imap_unordered(self, func, items):
+        """ Yields (item, result, exception) tuples as each call finishes """
+        items = list(items)
+        if len(items) == 0:
+            return
+
+        tasks = queue.Queue()
+        results = queue.Queue()
+        for item in items:
+            tasks.put(item)
+
+        def worker():
+            while True:
+                try:
+                    item = tasks.get_nowait()
+                except queue.Empty:
+                    return
+                try:
+                    results.put((item, func(item), None))
+                except Exception as e:
+                    results.put((item, None, e))
+
+        threads = []
+        for i in range(min(self.jobs, len(items))):
+            t = threading.Thread(target=worker)
+            t.daemon = True
+            t.start()
+            threads.append(t)
+
+        for i in range(len(items)):
+            yield results.get()
+
+        for t in threads:
+            t.join()
+
+
+class Pipeline(object):
+    """ Runs items through a series of stages, given as (func, jobs) pairs,
+    each on its own set of threads. An item moves on to the next stage as
+    soon as it's been through the last one, without waiting for the rest.
+
+    run(items) yields (item, result, exception) tuples as each item comes
+    out of the last stage, or drops out of an earlier one by raising.
+    """
+
+    def __init__(self, stages):
+        self.stages = [(func, max(1, int(jobs))) for func, jobs in stages]
+
+    def run(self, items):
+        items = list(items)
+        if len(items) == 0:
+            return
+
+        stages = self.stages
+        queues = [queue.Queue() for stage in stages]
+        results = queue.Queue()
+        done = object()
+        running = [jobs for func, jobs in stages]
+        lock = threading.Lock()
+
+        def worker(n):
+            func = stages[n][0]
+            while True:
+                task = queues[n].get()
+                if task is done:
+                    break
+                item, value = task
+                try:
+                    value = func(value)
+                except Exception as e:
+                    results.put((item, None, e))
+                    continue
+                if n + 1 < len(stages):
+                    queues[n + 1].put((item, value))
+                else:
+                    results.put((item, value, None))
+
+            # the last one out tells the next stage nothing else is coming
+            with lock:
+                running[n] -= 1
+                last = running[n] == 0
+            if last and n + 1 < len(stages):
+                for i in range(stages[n + 1][1]):
+                    queues[n + 1].put(done)
+
+        for item in items:
+            queues[0].put((item, item))
+        for i in range(stages[0][1]):
+            queues[0].put(done)
+
+        threads = []
+        for n, (func, jobs) in enumerate(stages):
+            for i in range(jobs):
+                t = threading.Thread(target=worker, args=(n,))
+                t.daemon = True
+                t.start()
+                threads.append(t)
+
+        for i in range(len(items)):
+            yield results.get()
+
+        for t in threads:
+            t.join()
+
+
+def retryable_errors():
+    """ Exceptions worth retrying a request after. requests is slow to
+    import, so this (and everything else that needs it) imports it when
+    it's first called, rather than when this module is loaded. """
+    global _RETRYABLE_ERRORS
+    if _RETRYABLE_ERRORS is not None:
+        return _RETRYABLE_ERRORS
+    import requests
+    errors = [
+        requests.ConnectionError, requests.Timeout,
+        requests.exceptions.ChunkedEncodingError
+    ]
+    try:
+        from urllib3 import exceptions as urllib3_exceptions
+    except ImportError:
+        from requests.packages.urllib3 import exceptions as \
+            urllib3_exceptions
+    errors += [
+        urllib3_exceptions.ProtocolError, urllib3_exceptions.ReadTimeoutError
+    ]
+    try:
+        import httpx  # used for --http2
+        errors.append(httpx.TransportError)
+    except ImportError:
+        pass
+    _RETRYABLE_ERRORS = tuple(errors)
+    return _RETRYABLE_ERRORS
+
+
+_RETRYABLE_ERRORS = None
+
+
+def _intern(value):
+    try:
+        return sys.intern(value)
+    except (AttributeError, TypeError):
+        return value  # Python 2 can't intern unicode strings
 
 
 class ServerModFile(object):
+    # there can be a lot of these, so don't give each one a __dict__
+    __slots__ = (
+        'api', 'file_name', 'name', 'release_type', 'download_url',
+        'game_version', 'project_id', 'md5', 'size', 'digest', 'server_mod'
+    )
+
     def __init__(self, api, file_name, name, release_type, download_url,
-                 game_version, project_id):
+                 game_version, project_id, md5=None, size=None, digest=None):
         self.api = api
         self.file_name = file_name
         self.name = name
-        self.release_type = release_type
+        self.release_type = _intern(release_type)
         self.download_url = download_url
-        self.game_version = game_version
+        self.game_version = _intern(game_version)
         self.project_id = project_id
+        self.md5 = md5
+        self.size = size  # these two aren't known from the API
+        self.digest = digest  # "algorithm:hex", see primary_digest
+        self.server_mod = None
 
     def __str__(self):
         return "ServerModFile: {0} ({1})".format(self.name, self.file_name)
@@ -44,7 +391,8 @@ class ServerModFile(object):
             release_type=dct['releaseType'],
             download_url=dct['downloadUrl'],
             game_version=dct['gameVersion'],
-            project_id=dct['projectId']
+            project_id=dct['projectId'],
+            md5=dct.get('md5')
         )
 
     def matches_filters(self, release_type=None, extension=None):
@@ -54,6 +402,109 @@ class ServerModFile(object):
             return False
         return True
 
+    @property
+    def extension(self):
+        """ The last dotted part of the file name, e.g. ".jar" """
+        dot = self.file_name.rfind('.')
+        return self.file_name[dot:] if dot != -1 else ''
+
+
+class FileCatalog(object):
+    """ Index over one project's files (oldest first, as the API lists
+    them) answering latest_file() for any (release_type, extension) filter
+    with a single dict lookup """
+    __slots__ = ('files', 'latest')
+
+    def __init__(self, files):
+        self.files = files
+        self.latest = {}
+        for f in files:
+            # later files overwrite earlier ones, so we end up with the newest
+            for key in ((None, None), (f.release_type, None),
+                        (None, f.extension), (f.release_type, f.extension)):
+                self.latest[key] = f
+
+    def latest_file(self, release_type=None, extension=None):
+        """ Returns the newest matching file, or None """
+        if extension is not None and extension.rfind('.') != 0:
+            # not something like ".jar", so it isn't in the index
+            for f in reversed(self.files):
+                if f.matches_filters(release_type, extension):
+                    return f
+            return None
+        return self.latest.get((release_type, extension))
+
+
+class Constraints(object):
+    """ Which files a server will take: those for its game_version (which
+    also matches builds of that version, so "CB 1.7" takes "CB 1.7.2-R0.3"),
+    of one of release_types, ending in extension. pins holds projects (by
+    ID) at the file with a particular name or file name, whatever else is
+    out. Anything left as None isn't constrained. """
+
+    def __init__(self, game_version=None, release_types=None, pins=None,
+                 extension='.jar'):
+        self.game_version = game_version
+        self.release_types = frozenset(release_types) \
+            if release_types else None
+        self.pins = dict((str(k), v) for k, v in (pins or {}).items())
+        self.extension = extension
+
+    def key(self):
+        """ Equal for equal constraints, for memoising on """
+        return (
+            self.game_version, tuple(sorted(self.release_types or ())),
+            tuple(sorted(self.pins.items())), self.extension
+        )
+
+    def is_default(self):
+        return self.game_version is None and self.release_types is None \
+            and len(self.pins) == 0
+
+    def merged(self, game_version=None, release_types=None, pins=None):
+        """ A copy with some constraints overridden, and more pins """
+        all_pins = dict(self.pins)
+        all_pins.update(pins or {})
+        return Constraints(
+            game_version or self.game_version,
+            release_types or self.release_types, all_pins, self.extension
+        )
+
+    def matches_game_version(self, game_version):
+        wanted = self.game_version
+        if wanted is None or game_version == wanted:
+            return True
+        return game_version is not None and \
+            game_version.startswith(wanted) and \
+            game_version[len(wanted)] in '.-_ '
+
+    def choose(self, project_id, files):
+        """ The newest of a project's files (listed oldest first) that
+        these constraints allow, or None """
+        pin = self.pins.get(str(project_id))
+        for f in reversed(files):
+            if not f.matches_filters(extension=self.extension):
+                continue
+            if pin is not None:
+                if pin in (f.name, f.file_name):
+                    return f
+            elif (self.release_types is None or
+                    f.release_type in self.release_types) and \
+                    self.matches_game_version(f.game_version):
+                return f
+        return None
+
+
+def parse_pins(pins):
+    """ Turns a list of "ID=VERSION" strings into a dict """
+    parsed = {}
+    for pin in pins or []:
+        project_id, sep, version = pin.partition('=')
+        if not sep or not project_id.strip().isdigit():
+            raise ValueError("pins look like ID=VERSION, not " + pin)
+        parsed[project_id.strip()] = version.strip()
+    return parsed
+
 
 class ServerMod(object):
     def __init__(self, api, id, slug=None, name=None, stage=None):
@@ -88,15 +539,13 @@ class ServerMod(object):
         return files
 
     def latest_file(self, **kwargs):
-        files = self.files()
-
-        # filter
-        files = [f for f in files if f.matches_filters(**kwargs)]
+        self.files()  # make sure they're fetched, with back references
 
-        if len(files) == 0:
+        f = self.api.catalog(self.id).latest_file(**kwargs)
+        if f is None:
             raise NoSuchFile()
 
-        return files[-1]
+        return f
 
 
 class ServerModAPIException(Exception):
@@ -125,248 +574,2521 @@ class NoSuchFile(ServerModAPIException):
     pass
 
 
-class ServerModAPI(object):
-    base_url = "http://api.curseforge.com/servermods/"
-    who_am_i = "PyServerModAPI/1.0"
+class NoSuchServerMod(ServerModAPIException):
+    pass
 
-    def __init__(self, api_key, who_am_i=None):
-        self.api_key = api_key
-        if who_am_i is not None:
-            self.who_am_i = who_am_i
-        self.file_cache = {}
-        self.client = requests.Session()
-        self.client.headers.update({
-            'X-API-Key': self.api_key,
-            'User-Agent': self.who_am_i
-        })
 
-    def build_url(self, url):
-        return self.base_url + url
+class CircuitOpenError(ServerModAPIException):
+    def __init__(self, host):
+        self.host = host
 
-    def get(self, url, query={}):
-        r = self.client.get(url, params=query)
-        print r.text
-        r.raise_for_status()
-        data = r.json()
+    def __str__(self):
+        return "CircuitOpenError: too many failures talking to {0}".format(
+            self.host
+        )
 
-        if 'errorCode' in data:
-            raise APIErrorException(data)
 
-        return data
+class DownloadIntegrityError(ServerModAPIException):
+    def __init__(self, file, reason):
+        self.file = file
+        self.reason = reason
 
-    def projects(self, search):
-        query = {
-            'search': search
-        }
-        url = self.build_url("/projects")
-        return [ServerMod.from_json(self, d) for d in self.get(url, query)]
+    def __str__(self):
+        return "DownloadIntegrityError: {0} ({1})".format(
+            self.file.file_name, self.reason
+        )
 
-    def files(self, project_id=None, project_ids=None):
-        id_query = []
-        if project_id is not None:
-            if int(project_id) in self.file_cache:
-                return self.file_cache[int(project_id)]
 
-            id_query = project_id
-        elif project_ids is not None:
-            id_query = ','.join([str(z) for z in project_ids])
-        else:
-            raise Exception(
-                "One of project_id or project_ids must be passed into files()"
+class TokenBucket(object):
+    """ Thread-safe token bucket allowing `rate` calls per second on
+    average, in bursts of up to `burst`. A rate of None only enforces
+    pauses, such as those asked for by a Retry-After header. """
+
+    def __init__(self, rate=None, burst=None):
+        import time
+        self.rate = float(rate) if rate else None
+        self.burst = float(burst or max(1, self.rate or 1))
+        self.tokens = self.burst
+        self.updated = time.time()
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        """ Waits until tokens are available. Asking for more than a burst
+        puts the bucket into debt, which later callers wait out. """
+        import time
+        while True:
+            with self.lock:
+                now = time.time()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                elif self.rate is None:
+                    return
+                else:
+                    self.refill(now)
+                    needed = min(tokens, self.burst)
+                    if self.tokens >= needed:
+                        self.tokens -= tokens
+                        return
+                    wait = (needed - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def refill(self, now):
+        if self.rate is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self.updated) * self.rate
             )
+        self.updated = now
 
-        if id_query == '':
-            return []
+    def set_rate(self, rate, burst=None):
+        """ Changes the rate, which anyone already waiting picks up when
+        they next wake up """
+        import time
+        with self.lock:
+            self.refill(time.time())
+            self.rate = float(rate) if rate else None
+            self.burst = float(burst or max(1, self.rate or 1))
+            self.tokens = min(self.tokens, self.burst)
 
-        query = {
-            'projectIds': id_query
-        }
-        url = self.build_url("/files")
-        files = [
-            ServerModFile.from_json(self, d) for d in self.get(url, query)
-        ]
+    def pause(self, seconds):
+        import time
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
 
-        # cache everything
-        for file in files:
-            if file.project_id in self.file_cache:
-                self.file_cache[file.project_id].append(file)
-            else:
-                self.file_cache[file.project_id] = [file]
 
-        if project_id is not None:
-            return files  # plain project ID
-        else:
-            file_tree = {}
-            for file in files:
-                if file.project_id in file_tree:
-                    file_tree[file.project_id].append(file)
-                else:
-                    file_tree[file.project_id] = [file]
+class BandwidthLimiter(object):
+    """ Caps the bytes per second downloads get, in total (rate) and for
+    each transfer (per_transfer). None means unlimited. Both can be changed
+    with set_rate and set_per_transfer while downloads are running. """
 
+    def __init__(self, rate=None, per_transfer=None):
+        self.bucket = TokenBucket(rate, burst=rate)  # a second's worth
+        self.per_transfer = float(per_transfer) if per_transfer else None
 
-class CLIStorage(object):
-    def __init__(self, folder):
-        self.dir = folder
-        self.path = os.path.join(folder, '.servermods.json')
-        self.load()
+    @property
+    def rate(self):
+        return self.bucket.rate
 
-    def load(self):
-        if not os.path.exists(self.path):
-            self.data = {
-                'version': 1,
-                'installed': {},
-                'apikey': None
-            }
-            self.save()
-            return
+    def set_rate(self, rate):
+        self.bucket.set_rate(rate, burst=rate)
 
-        with open(self.path, 'r') as f:
-            self.data = json.load(f)
+    def set_per_transfer(self, rate):
+        self.per_transfer = float(rate) if rate else None
 
-    def api_key():
-        doc = "The api_key property."
+    def transfer(self):
+        """ A bucket for one transfer, to pass to throttle() """
+        return TokenBucket(self.per_transfer, burst=self.per_transfer)
 
-        def fget(self):
-            return self._api_key
+    def chunk_size(self, default):
+        """ How much to read at a time; about a tenth of a second's worth
+        when limited, so the transfer doesn't come in lumps """
+        rates = [r for r in [self.rate, self.per_transfer] if r]
+        if len(rates) == 0:
+            return default
+        return int(max(1024, min([default] + [r / 10 for r in rates])))
 
-        def fset(self, value):
-            self._api_key = value
+    def throttle(self, transfer, size):
+        """ Waits until size more bytes may be read by transfer """
+        if transfer.rate != self.per_transfer:
+            transfer.set_rate(self.per_transfer, burst=self.per_transfer)
+        transfer.acquire(size)
+        self.bucket.acquire(size)
 
-        return {'doc': doc, 'fget': fget, 'fset': fset}
-    api_key = property(**api_key())
 
-    def save(self):
-        with open(self.path, 'w') as f:
-            json.dump(self.data, f)
+def format_time(timestamp):
+    import time
+    return time.strftime('%Y-%m-%d %H:%M', time.localtime(timestamp))
 
-    def get_hash(self, filename):
-        import hashlib
-        path = os.path.join(self.dir, filename)
-        md5 = hashlib.md5()
-        with open(path, 'rb') as f:
-            eof = False
-            while not eof:
-                buf = f.read(128)  # 128 == MD5 digest block size
-                if len(buf) < 128:
-                    eof = True
-                md5.update(buf)
-        return md5.hexdigest()
 
-    def installed(self, mod, file, filename):
-        store_data = {
-            'server_mod_id': mod.id,
-            'server_mod_name': mod.name,
-            'filename': filename,
-            'file_version': file.name,
-            'download_url': file.download_url,
-            'hash': self.get_hash(filename)
-        }
-        self.data['installed'][str(mod.id)] = store_data
-        return self
+def parse_size(value):
+    """ Parses a number of bytes such as 512K or 2M (binary units) """
+    multipliers = {'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+    value = value.strip().lower()
+    if value.endswith('b'):
+        value = value[:-1]
+    multiplier = multipliers.get(value[-1:], 1)
+    if value[-1:] in multipliers:
+        value = value[:-1]
+    return int(float(value) * multiplier)
 
-    def removed(self, mod, file):
-        del self.data['installed'][str(mod.id)]
-        return self
 
-    def recheck(self):
-        lost_files = {}
-        renamed_files = {}
-        known_files = set()
-        dataset = self.get_data()
-        for data in dataset.values():
-            # does file still exist?
-            if not os.path.exists(os.path.join(self.dir, data['filename'])):
-                lost_files[data['hash']] = data
-            else:
-                known_files.add(data['filename'])
+def parse_rate(value):
+    """ Parses a byte rate such as 512K or 2M/s, see parse_size """
+    value = value.strip()
+    if value.lower().endswith('/s'):
+        value = value[:-2]
+    return float(parse_size(value))
 
-        # now check to see if they just renamed the file to confuse me
-        for fn in os.listdir(self.dir):
-            if fn in known_files:
-                continue
-            # md5 hash the file
-            md5 = self.get_hash(fn)
-            if md5 in lost_files.keys():
-                # identified!
-                renamed_file = lost_files[md5]
-                smid = str(renamed_file['server_mod_id'])
 
-                renamed_file['filename'] = fn
-                renamed_files[smid] = renamed_file
+class CircuitBreaker(object):
+    """ Stops calls to a host after `threshold` failures in a row, then
+    lets a single trial call through every `cooldown` seconds """
 
-        # now delete all the files from the DB that we still don't know about
-        for data in lost_files.values():
-            del dataset[str(data['server_mod_id'])]
+    def __init__(self, threshold=5, cooldown=30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
 
-        # and add all the renamed files back in
-        for data in renamed_files.values():
-            dataset[str(data['server_mod_id'])] = data
+    def allow(self):
+        import time
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.time() - self.opened_at >= self.cooldown:
+                self.opened_at = time.time()  # half open: one trial call
+                return True
+            return False
 
-        self.data['installed'] = dataset
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
 
-        return self
+    def failure(self):
+        import time
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened_at = time.time()
 
-    def get_data(self):
-        return self.data['installed']
 
+class RequestScheduler(object):
+    """ Runs requests with retries, exponential backoff with full jitter,
+    Retry-After handling, a per-host token bucket and a per-host circuit
+    breaker. One scheduler is meant to be shared between threads. """
+    retry_statuses = (429, 500, 502, 503, 504)
+    max_retry_after = 120.0
 
-class CommandLineClient(object):
-    BUFSIZE = 1024
+    def __init__(self, rate=None, burst=None, max_retries=4, backoff=0.5,
+                 max_backoff=30.0, breaker_threshold=5, breaker_cooldown=30.0,
+                 on_retry=None):
+        self.rate = rate
+        self.burst = burst
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.on_retry = on_retry
+        self.buckets = {}
+        self.breakers = {}
+        self.lock = threading.Lock()
 
-    def __init__(self, api_cls=ServerModAPI):
+    def _host(self, url):
         try:
-            import argparse
+            from urllib.parse import urlparse
         except ImportError:
-            raise Exception("Please upgrade to Python 2.7+ to use this tool.")
+            from urlparse import urlparse  # Python 2
+        return urlparse(url).netloc
 
-        self.api_cls = api_cls
+    def bucket(self, host):
+        with self.lock:
+            if host not in self.buckets:
+                self.buckets[host] = TokenBucket(self.rate, self.burst)
+            return self.buckets[host]
+
+    def breaker(self, host):
+        with self.lock:
+            if host not in self.breakers:
+                self.breakers[host] = CircuitBreaker(
+                    self.breaker_threshold, self.breaker_cooldown
+                )
+            return self.breakers[host]
+
+    def call(self, url, func):
+        """ Calls func() until it succeeds, raises something that isn't
+        worth retrying, or runs out of retries """
+        import time
+        host = self._host(url)
+        attempt = 0
+        while True:
+            breaker = self.breaker(host)
+            if not breaker.allow():
+                raise CircuitOpenError(host)
+            self.bucket(host).acquire()
+
+            try:
+                result = func()
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, host)
+                if delay is None:
+                    breaker.success()  # the host is fine, the request isn't
+                    raise
+                breaker.failure()
+                if attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                if self.on_retry is not None:
+                    self.on_retry(url)
+                time.sleep(delay)
+                continue
+
+            breaker.success()
+            return result
+
+    def retry_delay(self, error, attempt, host):
+        """ How long to wait before retrying after error, or None if it
+        shouldn't be retried """
+        import random
+        import requests
+        if isinstance(error, requests.HTTPError):
+            response = error.response
+            if response is None or \
+                    response.status_code not in self.retry_statuses:
+                return None
+            retry_after = self.parse_retry_after(
+                response.headers.get('Retry-After')
+            )
+            if retry_after is not None:
+                retry_after = min(retry_after, self.max_retry_after)
+                if response.status_code == 429:
+                    # everyone talking to this host should slow down
+                    self.bucket(host).pause(retry_after)
+                return retry_after
+        elif not isinstance(error, retryable_errors()):
+            return None
+
+        return random.uniform(
+            0, min(self.max_backoff, self.backoff * (2 ** attempt))
+        )
+
+    def parse_retry_after(self, value):
+        import time
+        from email.utils import parsedate_tz, mktime_tz
+        if value is None:
+            return None
+        value = value.strip()
+        if value.isdigit():
+            return float(value)
+        parsed = parsedate_tz(value)
+        if parsed is None:
+            return None
+        return max(0.0, mktime_tz(parsed) - time.time())
+
+
+class Instrumentation(object):
+    """ Collects timings and counters from the API client and downloads.
+
+    Hooks registered with add_hook('before_request', func) are called with
+    (url, query) before every API request, and 'after_request' hooks with
+    (url, query, response, elapsed) afterwards (response is None if the
+    request raised). Everything collected can be exported with to_json()
+    or to_prometheus().
+    """
+    latency_buckets = (
+        0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0
+    )
+    api_endpoints = ('/projects', '/files')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.hooks = {'before_request': [], 'after_request': []}
+        self.endpoints = {}
+        self.cache = {'hits': 0, 'misses': 0}
+        self.downloads = []
+        self.phases = []
+
+    def add_hook(self, event, func):
+        self.hooks[event].append(func)
+
+    def endpoint(self, url):
+        endpoint = '/' + url.split('?', 1)[0].rstrip('/').rsplit('/', 1)[-1]
+        if endpoint not in self.api_endpoints:
+            return 'download'  # anything else is a file being downloaded
+        return endpoint
+
+    def _endpoint_stats(self, endpoint):
+        if endpoint not in self.endpoints:
+            self.endpoints[endpoint] = {
+                'requests': 0,
+                'errors': 0,
+                'retries': 0,
+                'bytes': 0,
+                'latency_sum': 0.0,
+                'latency_buckets': [0] * len(self.latency_buckets),
+            }
+        return self.endpoints[endpoint]
+
+    def before_request(self, url, query):
+        for hook in self.hooks['before_request']:
+            hook(url, query)
+
+    def after_request(self, url, query, response, elapsed):
+        with self.lock:
+            stats = self._endpoint_stats(self.endpoint(url))
+            stats['requests'] += 1
+            stats['latency_sum'] += elapsed
+            for i, bound in enumerate(self.latency_buckets):
+                if elapsed <= bound:
+                    stats['latency_buckets'][i] += 1
+            if response is None or response.status_code >= 400:
+                stats['errors'] += 1
+            if response is not None:
+                size = response.headers.get('Content-Length')
+                if size is not None and size.isdigit():
+                    stats['bytes'] += int(size)
+                elif getattr(response, '_content_consumed', True):
+                    # (don't read the body of a streamed response)
+                    stats['bytes'] += len(response.content)
+        for hook in self.hooks['after_request']:
+            hook(url, query, response, elapsed)
+
+    def record_retry(self, url):
+        with self.lock:
+            self._endpoint_stats(self.endpoint(url))['retries'] += 1
+
+    def record_cache(self, hit):
+        with self.lock:
+            self.cache['hits' if hit else 'misses'] += 1
+
+    def record_download(self, url, size, elapsed):
+        with self.lock:
+            self.downloads.append({
+                'url': url,
+                'bytes': size,
+                'seconds': elapsed,
+                'bytes_per_second': size / elapsed if elapsed > 0 else None
+            })
+
+    def phase(self, name):
+        """ Context manager timing a named phase of a command """
+        import time
+        instrumentation = self
+
+        class Phase(object):
+            def __enter__(self):
+                self.start = time.time()
+
+            def __exit__(self, *exc_info):
+                instrumentation.record_phase(name, time.time() - self.start)
+
+        return Phase()
+
+    def record_phase(self, name, elapsed):
+        with self.lock:
+            for phase in self.phases:
+                if phase[0] == name:
+                    phase[1] += elapsed
+                    return
+            self.phases.append([name, elapsed])
+
+    def to_dict(self):
+        with self.lock:
+            return {
+                'endpoints': self.endpoints,
+                'latency_buckets': list(self.latency_buckets),
+                'cache': self.cache,
+                'downloads': self.downloads,
+                'phases': [{'name': n, 'seconds': t} for n, t in self.phases]
+            }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2, sort_keys=True)
+
+    def to_prometheus(self):
+        data = self.to_dict()
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append('# HELP servermod_{0} {1}'.format(name, help_text))
+            lines.append('# TYPE servermod_{0} {1}'.format(name, kind))
+            for suffix, labels, value in samples:
+                label_str = ','.join(
+                    '{0}="{1}"'.format(k, v) for k, v in labels
+                )
+                lines.append('servermod_{0}{1}{{{2}}} {3}'.format(
+                    name, suffix, label_str, value
+                ).replace('{}', ''))
+
+        endpoints = sorted(data['endpoints'].items())
+        for name, key, help_text in [
+                ('requests_total', 'requests', 'API requests made'),
+                ('request_errors_total', 'errors', 'API requests that failed'),
+                ('request_retries_total', 'retries', 'API requests retried'),
+                ('response_bytes_total', 'bytes', 'API response body bytes')]:
+            metric(name, 'counter', help_text, [
+                ('', [('endpoint', e)], stats[key]) for e, stats in endpoints
+            ])
+
+        samples = []
+        for e, stats in endpoints:
+            for bound, count in zip(data['latency_buckets'],
+                                    stats['latency_buckets']):
+                samples.append(
+                    ('_bucket', [('endpoint', e), ('le', bound)], count)
+                )
+            samples.append(
+                ('_bucket', [('endpoint', e), ('le', '+Inf')],
+                 stats['requests'])
+            )
+            samples.append(('_sum', [('endpoint', e)], stats['latency_sum']))
+            samples.append(('_count', [('endpoint', e)], stats['requests']))
+        metric('request_duration_seconds', 'histogram',
+               'API request latency', samples)
+
+        metric('cache_hits_total', 'counter', 'API responses from the cache',
+               [('', [], data['cache']['hits'])])
+        metric('cache_misses_total', 'counter', 'API responses not cached',
+               [('', [], data['cache']['misses'])])
+
+        downloads = data['downloads']
+        metric('downloads_total', 'counter', 'files downloaded',
+               [('', [], len(downloads))])
+        metric('download_bytes_total', 'counter', 'bytes downloaded',
+               [('', [], sum(d['bytes'] for d in downloads))])
+        metric('download_seconds_total', 'counter', 'time spent downloading',
+               [('', [], sum(d['seconds'] for d in downloads))])
+
+        metric('phase_seconds', 'gauge', 'time spent in each phase', [
+            ('', [('phase', p['name'])], p['seconds'])
+            for p in data['phases']
+        ])
+
+        return '\n'.join(lines) + '\n'
+
+
+class ResponseCache(object):
+    """ Persistent on-disk cache of API responses.
+
+    Entries are keyed on the endpoint plus a normalised query string, expire
+    after a per-endpoint TTL and are then revalidated using the ETag or
+    Last-Modified headers the server gave us. The least recently used
+    entries are evicted once the cache grows beyond max_size bytes.
+    """
+    default_ttls = {
+        '/projects': 24 * 60 * 60,
+        '/files': 60 * 60,
+    }
+    max_size = 32 * 1024 * 1024
+    # other things (like the slug index) can share the directory, so
+    # entries are told apart by their name
+    entry_prefix = 'response-'
+
+    def __init__(self, folder, ttls=None, max_size=None):
+        self.dir = folder
+        self.ttls = dict(self.default_ttls)
+        if ttls is not None:
+            self.ttls.update(ttls)
+        if max_size is not None:
+            self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+        self.lock = threading.Lock()
+        if self.dir is not None and not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+    @classmethod
+    def default_dir(clz, plugins_dir):
+        xdg_cache = os.environ.get('XDG_CACHE_HOME')
+        if xdg_cache:
+            return os.path.join(xdg_cache, 'servermods')
+        return os.path.join(plugins_dir, '.servermods-cache')
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'revalidations': self.revalidations,
+        }
+
+    def ttl(self, url):
+        for endpoint, ttl in self.ttls.items():
+            if url.endswith(endpoint):
+                return ttl
+        return 0
+
+    def normalise_query(self, query):
+        normalised = []
+        for key, value in sorted(query.items()):
+            value = str(value)
+            if key == 'projectIds':
+                # the order of IDs doesn't change the response
+                value = ','.join(sorted(value.split(','), key=lambda z: (
+                    len(z), z
+                )))
+            normalised.append('{0}={1}'.format(key, value))
+        return '&'.join(normalised)
+
+    def key_path(self, url, query):
+        import hashlib
+        key = url + '?' + self.normalise_query(query)
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.dir, self.entry_prefix + digest + '.json')
+
+    def lookup(self, url, query):
+        """ Returns a cached entry (or None), and whether it's still fresh """
+        import time
+        entry = self._read(url, query)
+        if entry is None:
+            return None, False
+
+        fresh = time.time() - entry['fetched'] < self.ttl(url)
+        return entry, fresh
+
+    def _read(self, url, query):
+        path = self.key_path(url, query)
+        try:
+            with open(path, 'r') as f:
+                entry = json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+        try:
+            os.utime(path, None)  # mark as recently used
+        except OSError:
+            pass
+        return entry
+
+    def revalidation_headers(self, entry):
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def record(self, hit=False, revalidated=False):
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+            if revalidated:
+                self.revalidations += 1
+
+    def store(self, url, query, data, headers, entry=None):
+        import time
+        if entry is None:
+            entry = {
+                'url': url,
+                'query': self.normalise_query(query),
+                'data': data,
+                'etag': headers.get('ETag'),
+                'last_modified': headers.get('Last-Modified'),
+            }
+        entry['fetched'] = time.time()
+
+        self._write(url, query, entry)
+        self.evict()
+
+    def _write(self, url, query, entry):
+        path = self.key_path(url, query)
+        tmp_path = '{0}.{1}.tmp'.format(path, threading.current_thread().ident)
+        with open(tmp_path, 'w') as f:
+            json.dump(entry, f)
+        replace_file(tmp_path, path)
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total_size = 0
+            for fn in os.listdir(self.dir):
+                if not self.is_entry(fn):
+                    continue
+                path = os.path.join(self.dir, fn)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((st.st_mtime, st.st_size, path))
+                total_size += st.st_size
+
+            entries.sort()
+            for mtime, size, path in entries:
+                if total_size <= self.max_size:
+                    break
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                total_size -= size
+
+    def clear(self):
+        for fn in os.listdir(self.dir):
+            if self.is_entry(fn):
+                os.remove(os.path.join(self.dir, fn))
+
+    def is_entry(self, fn):
+        return fn.startswith(self.entry_prefix) and fn.endswith('.json')
+
+
+class MemoryResponseCache(ResponseCache):
+    """ ResponseCache that lives in memory, for long running processes.
+    max_size is a number of entries rather than bytes. """
+    max_size = 1024
+
+    def __init__(self, ttls=None, max_size=None):
+        self.entries = OrderedDict()
+        ResponseCache.__init__(self, None, ttls=ttls, max_size=max_size)
+
+    def _key(self, url, query):
+        return url + '?' + self.normalise_query(query)
+
+    def _read(self, url, query):
+        with self.lock:
+            entry = self.entries.pop(self._key(url, query), None)
+            if entry is not None:
+                self.entries[self._key(url, query)] = entry  # most recent
+            return entry
+
+    def _write(self, url, query, entry):
+        with self.lock:
+            self.entries.pop(self._key(url, query), None)
+            self.entries[self._key(url, query)] = entry
+
+    def evict(self):
+        with self.lock:
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+
+class SlugIndex(object):
+    """ Persistent map of project slug -> project, filled in from every
+    /projects response, so that slugs we've seen before can be turned
+    into projects without asking the API again. Entries are trusted for
+    ttl seconds. """
+    ttl = 7 * 24 * 60 * 60
+
+    def __init__(self, path, ttl=None):
+        self.path = path
+        if ttl is not None:
+            self.ttl = ttl
+        self.lock = threading.Lock()
+        self.dirty = False
+        self.hits = 0
+        self.misses = 0
+        try:
+            with open(path, 'r') as f:
+                self.entries = json.load(f)
+        except (IOError, OSError, ValueError):
+            self.entries = {}
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses}
+
+    def record(self, mods):
+        import time
+        now = time.time()
+        with self.lock:
+            for mod in mods:
+                self.entries[mod.slug] = {
+                    'id': mod.id,
+                    'name': mod.name,
+                    'stage': mod.stage,
+                    'fetched': now,
+                }
+            self.dirty = True
+
+    def lookup(self, api, slug):
+        """ Returns a ServerMod for slug, or None if we don't know it (or
+        haven't checked on it for too long) """
+        import time
+        with self.lock:
+            entry = self.entries.get(slug)
+            if entry is None or time.time() - entry['fetched'] > self.ttl:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return ServerMod(
+            api=api, id=entry['id'], slug=slug, name=entry['name'],
+            stage=entry['stage']
+        )
+
+    def save(self):
+        with self.lock:
+            if not self.dirty:
+                return self
+            serialised = json.dumps(self.entries)
+            self.dirty = False
+        folder = os.path.dirname(self.path)
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            f.write(serialised)
+        replace_file(tmp_path, self.path)
+        return self
+
+
+class HTTP2Session(object):
+    """ Looks enough like a requests.Session for downloading files, but
+    multiplexes requests to each host over one HTTP/2 connection, using
+    httpx. """
+
+    def __init__(self, headers, max_connections):
+        try:
+            import httpx
+            import h2  # noqa: F401 (httpx needs it for HTTP/2)
+        except ImportError:
+            raise Exception(
+                "Please install httpx with HTTP/2 support (pip install " +
+                "'httpx[http2]') to download over HTTP/2."
+            )
+        self.client = httpx.Client(
+            http2=True, headers=headers, limits=httpx.Limits(
+                max_connections=max_connections,
+                max_keepalive_connections=max_connections
+            )
+        )
+
+    def get(self, url, stream=False, headers=None, timeout=None):
+        request = self.client.build_request(
+            'GET', url, headers=headers, timeout=timeout
+        )
+        return HTTP2Response(self.client.send(request, stream=True))
+
+    def head(self, url, allow_redirects=False, timeout=None):
+        return HTTP2Response(self.client.head(
+            url, follow_redirects=allow_redirects, timeout=timeout
+        ))
+
+    def close(self):
+        self.client.close()
+
+
+class HTTP2Response(object):
+    """ Wraps an httpx response in the bits of the requests.Response API
+    that download() uses """
+
+    def __init__(self, response):
+        self.response = response
+        self.status_code = response.status_code
+        self.headers = response.headers
+        self.raw = self  # for raw.read()
+        self.chunks = None
+        self.buffer = b''
+
+    def raise_for_status(self):
+        import requests
+        if self.status_code >= 400:
+            self.close()
+            raise requests.HTTPError(
+                '{0} error for {1}'.format(
+                    self.status_code, self.response.url
+                ), response=self
+            )
+
+    def read(self, size):
+        if self.chunks is None:
+            self.chunks = self.response.iter_raw()
+        while len(self.buffer) < size:
+            try:
+                self.buffer += next(self.chunks)
+            except StopIteration:
+                break
+        buf, self.buffer = self.buffer[:size], self.buffer[size:]
+        return buf
+
+    def close(self):
+        self.response.close()
+
+
+class ServerModAPI(object):
+    base_url = "http://api.curseforge.com/servermods/"
+    who_am_i = "PyServerModAPI/1.0"
+    max_ids_length = 1500  # keeps /files URLs well under common limits
+    jobs = 1
+    timeout = 30
+    pool_hosts = 10  # how many hosts to keep connections open to
+    pool_per_host = None  # connections to each of them, defaults to jobs
+    http2 = False
+
+    def __init__(self, api_key, who_am_i=None, cache=None, jobs=None,
+                 instrumentation=None, scheduler=None, slug_index=None,
+                 pool_per_host=None, http2=None):
+        self.api_key = api_key
+        if who_am_i is not None:
+            self.who_am_i = who_am_i
+        if jobs is not None:
+            self.jobs = jobs
+        if pool_per_host is not None:
+            self.pool_per_host = pool_per_host
+        if http2 is not None:
+            self.http2 = http2
+        self.file_cache = {}
+        self.catalogs = {}
+        self.resolutions = {}  # (constraints key, ID) -> (catalog, file)
+        self.cache = cache
+        self.slug_index = slug_index
+        if instrumentation is None:
+            instrumentation = Instrumentation()
+        self.instrumentation = instrumentation
+        if scheduler is None:
+            scheduler = RequestScheduler()
+        if scheduler.on_retry is None:
+            scheduler.on_retry = instrumentation.record_retry
+        self.scheduler = scheduler
+        self._client = None
+        self._http2_client = None
+        self._client_lock = threading.Lock()
+
+    @property
+    def client(self):
+        """ The requests.Session API calls (and, unless http2 is set,
+        downloads) are made with, created when the first call is made.
+        Connections are kept alive, up to pool_per_host to each host. The
+        pool doesn't block when it runs out, since a connection that never
+        gets released would otherwise hang every request after it. """
+        with self._client_lock:
+            if self._client is None:
+                import requests
+                client = requests.Session()
+                adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_hosts,
+                    pool_maxsize=self.pool_per_host or self.jobs
+                )
+                client.mount('http://', adapter)
+                client.mount('https://', adapter)
+                # the API key only goes to the API, see _request
+                client.headers.update({'User-Agent': self.who_am_i})
+                self._client = client
+            return self._client
+
+    @client.setter
+    def client(self, session):
+        self._client = session
+
+    def download_session(self):
+        """ The session to download files with: client, or an HTTP2Session
+        if http2 is set """
+        if not self.http2:
+            return self.client
+        with self._client_lock:
+            if self._http2_client is None:
+                self._http2_client = HTTP2Session(
+                    {'User-Agent': self.who_am_i},
+                    max_connections=self.pool_hosts * (
+                        self.pool_per_host or self.jobs
+                    )
+                )
+            return self._http2_client
+
+    def build_url(self, url):
+        return self.base_url + url
+
+    def _request(self, url, query, headers, stream=False):
+        import time
+        instrumentation = self.instrumentation
+
+        headers = dict(headers)
+        headers['X-API-Key'] = self.api_key
+
+        def attempt():
+            instrumentation.before_request(url, query)
+            start = time.time()
+            r = None
+            try:
+                r = self.client.get(
+                    url, params=query, headers=headers, timeout=self.timeout,
+                    stream=stream
+                )
+            finally:
+                instrumentation.after_request(
+                    url, query, r, time.time() - start
+                )
+            if r.status_code in self.scheduler.retry_statuses:
+                # let the scheduler retry it, giving a streamed response's
+                # connection back first
+                r.close()
+                r.raise_for_status()
+            return r
+
+        return self.scheduler.call(url, attempt)
+
+    def get(self, url, query={}):
+        cache = self.cache
+        entry = None
+        headers = {}
+        if cache is not None:
+            entry, fresh = cache.lookup(url, query)
+            if fresh:
+                cache.record(hit=True)
+                self.instrumentation.record_cache(hit=True)
+                return entry['data']
+            headers = cache.revalidation_headers(entry)
+
+        r = self._request(url, query, headers)
+        if r.status_code == 304 and entry is not None:
+            cache.record(hit=True, revalidated=True)
+            self.instrumentation.record_cache(hit=True)
+            cache.store(url, query, entry['data'], r.headers, entry=entry)
+            return entry['data']
+        if cache is not None:
+            cache.record(hit=False)
+            self.instrumentation.record_cache(hit=False)
+
+        r.raise_for_status()
+        data = r.json()
+
+        if 'errorCode' in data:
+            raise APIErrorException(data)
+
+        if cache is not None:
+            cache.store(url, query, data, r.headers)
+
+        return data
+
+    def projects(self, search):
+        query = {
+            'search': search
+        }
+        url = self.build_url("/projects")
+        mods = [ServerMod.from_json(self, d) for d in self.get(url, query)]
+        if self.slug_index is not None:
+            self.slug_index.record(mods)
+        return mods
+
+    def chunk_project_ids(self, project_ids):
+        """ Splits project IDs into lists whose comma separated form fits
+        within max_ids_length characters """
+        chunks = []
+        chunk = []
+        length = 0
+        for project_id in project_ids:
+            project_id = str(project_id)
+            extra = len(project_id) + (1 if chunk else 0)
+            if chunk and length + extra > self.max_ids_length:
+                chunks.append(chunk)
+                chunk = []
+                length = 0
+                extra = len(project_id)
+            chunk.append(project_id)
+            length += extra
+        if chunk:
+            chunks.append(chunk)
+        return chunks
+
+    def _fetch_files(self, project_ids):
+        query = {
+            'projectIds': ','.join(project_ids)
+        }
+        url = self.build_url("/files")
+        return [
+            ServerModFile.from_json(self, d) for d in self.get(url, query)
+        ]
+
+    def files(self, project_id=None, project_ids=None, jobs=None):
+        """ Fetches the files for a single project_id (returning a list), or
+        for several project_ids (returning a dict of project ID -> list).
+
+        Projects already in file_cache aren't fetched again, and the rest
+        are requested in chunks of IDs, jobs chunks at a time.
+        """
+        if project_id is not None:
+            return self.files(project_ids=[project_id], jobs=jobs)[
+                int(project_id)
+            ]
+        elif project_ids is None:
+            raise Exception(
+                "One of project_id or project_ids must be passed into files()"
+            )
+
+        project_ids = [int(z) for z in project_ids]
+        missing = []
+        for z in project_ids:
+            if z not in self.file_cache and z not in missing:
+                missing.append(z)
+
+        if len(missing) > 0:
+            # projects without any files still get an (empty) cache entry
+            file_tree = dict((z, []) for z in missing)
+            chunks = self.chunk_project_ids(missing)
+            pool = WorkerPool(jobs if jobs is not None else self.jobs)
+            for chunk, files, error in pool.imap_unordered(
+                    self._fetch_files, chunks):
+                if error is not None:
+                    raise error
+                for file in files:
+                    file_tree.setdefault(file.project_id, []).append(file)
+
+            # cache everything
+            self.file_cache.update(file_tree)
+            for z, files in file_tree.items():
+                self.catalogs[z] = FileCatalog(files)
+
+        return dict((z, self.file_cache[z]) for z in project_ids)
+
+    def iter_files(self, project_ids):
+        """ Yields the files for project_ids as the response is parsed.
+
+        Projects already in file_cache are served from there. The others
+        are streamed and never kept, so they aren't added to file_cache
+        (or the ResponseCache) either.
+        """
+        import codecs
+        project_ids = [int(z) for z in project_ids]
+        missing = []
+        for z in project_ids:
+            if z in self.file_cache:
+                for file in self.file_cache[z]:
+                    yield file
+            elif z not in missing:
+                missing.append(z)
+
+        url = self.build_url("/files")
+        for chunk in self.chunk_project_ids(missing):
+            query = {
+                'projectIds': ','.join(chunk)
+            }
+            r = self._request(url, query, {}, stream=True)
+            try:
+                r.raise_for_status()
+                decoder = codecs.getincrementaldecoder(
+                    r.encoding or 'utf-8'
+                )()
+                text = (
+                    decoder.decode(b) for b in r.iter_content(64 * 1024)
+                )
+                for d in iter_json_array(text):
+                    yield ServerModFile.from_json(self, d)
+            finally:
+                r.close()
+
+    def latest_files(self, project_ids, **kwargs):
+        """ Returns {project_id: newest ServerModFile matching kwargs} (the
+        filters of ServerMod.latest_file) for the projects that have one.
+
+        Without a ResponseCache the listings are streamed with iter_files,
+        keeping only the newest match per project. With one, they go through
+        files() so that the cache gets used.
+        """
+        latest = {}
+        if self.cache is not None:
+            self.files(project_ids=project_ids)
+            for z in project_ids:
+                f = self.catalog(z).latest_file(**kwargs)
+                if f is not None:
+                    latest[int(z)] = f
+            return latest
+
+        for f in self.iter_files(project_ids):
+            if f.matches_filters(**kwargs):
+                latest[f.project_id] = f
+        return latest
+
+    def resolve(self, constraints, project_ids):
+        """ Returns {project_id: ServerModFile} with the file constraints
+        choose for each of project_ids, for those that have one.
+
+        The listings go through files(), so they come from (and go into)
+        the cache, and each choice is remembered until its project's
+        listing is fetched again. Servers with the same constraints then
+        only cost one resolution between them.
+        """
+        project_ids = [int(z) for z in project_ids]
+        self.files(project_ids=project_ids)
+        key = constraints.key()
+        chosen = {}
+        for z in project_ids:
+            catalog = self.catalog(z)
+            resolution = self.resolutions.get((key, z))
+            if resolution is None or resolution[0] is not catalog:
+                resolution = (catalog, constraints.choose(z, catalog.files))
+                self.resolutions[(key, z)] = resolution
+            if resolution[1] is not None:
+                chosen[z] = resolution[1]
+        return chosen
+
+    def forget_files(self, project_ids):
+        """ Drops projects from file_cache, so they're fetched again """
+        for z in project_ids:
+            self.file_cache.pop(int(z), None)
+            self.catalogs.pop(int(z), None)
+
+    def catalog(self, project_id):
+        """ The FileCatalog for a project whose files have been fetched """
+        project_id = int(project_id)
+        catalog = self.catalogs.get(project_id)
+        if catalog is None or catalog.files is not \
+                self.file_cache[project_id]:
+            catalog = self.catalogs[project_id] = FileCatalog(
+                self.file_cache[project_id]
+            )
+        return catalog
+
+
+def mtime_ns(st):
+    mtime_ns = getattr(st, 'st_mtime_ns', None)
+    if mtime_ns is None:
+        mtime_ns = int(st.st_mtime * 1000000000)  # Python 2
+    return mtime_ns
+
+
+class DirectorySnapshot(object):
+    """ Which names are in a directory, and which of those are regular
+    files. The listing is taken with os.scandir where there is one, which
+    can usually tell files from directories without a stat() each, and is
+    cached at path between runs.
+
+    Adding, removing or renaming anything in a directory changes its mtime,
+    so while that stays the same the cached listing is still right, and
+    looking at the directory costs a single stat(). Listings taken less than
+    `racy` seconds after the directory last changed aren't reused, since
+    another change within the same mtime tick wouldn't show.
+    """
+    racy = 2.0
+
+    def __init__(self, folder, path):
+        self.dir = folder
+        self.path = path
+        self.names = None  # name -> whether it's a regular file
+        self.entries = {}  # name -> os.DirEntry, whose stat() is cached
+        self.cached = False
+
+    def scan(self):
+        import time
+        dir_mtime = mtime_ns(os.stat(self.dir))
+        cached = self._load()
+        if cached is not None and cached['mtime_ns'] == dir_mtime and \
+                cached['scanned'] - dir_mtime / 1e9 >= self.racy:
+            self.names = cached['names']
+            self.cached = True
+            return self
+
+        scanned = time.time()
+        self.names = {}
+        self.entries = {}
+        scandir = getattr(os, 'scandir', None)  # Python 3.5+
+        if scandir is not None:
+            for entry in scandir(self.dir):
+                try:
+                    self.names[entry.name] = entry.is_file()
+                except OSError:
+                    continue  # went away while we were looking at it
+                self.entries[entry.name] = entry
+        else:
+            for fn in os.listdir(self.dir):
+                try:
+                    st = os.stat(os.path.join(self.dir, fn))
+                except OSError:
+                    continue
+                self.names[fn] = stat.S_ISREG(st.st_mode)
+        self._save({
+            'mtime_ns': dir_mtime, 'scanned': scanned, 'names': self.names
+        })
+        return self
+
+    def stat(self, name):
+        entry = self.entries.get(name)
+        if entry is not None:
+            return entry.stat()
+        return os.stat(os.path.join(self.dir, name))
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _save(self, cached):
+        try:
+            if not os.path.isdir(os.path.dirname(self.path)):
+                os.makedirs(os.path.dirname(self.path))
+            tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+            with open(tmp_path, 'w') as f:
+                json.dump(cached, f)
+            replace_file(tmp_path, self.path)
+        except (IOError, OSError):
+            pass  # we'll just have to look again next time
+
+
+class CLIStorage(object):
+    """ The install database for one plugins directory.
+
+    .servermods.json is only ever replaced atomically by save(). In between
+    saves, installed() and removed() append each change to
+    .servermods.journal, which load() replays (and then compacts into the
+    database), so an interrupted run keeps track of whatever it had already
+    installed. Other processes reading the database will always see a
+    complete file.
+
+    Journal lines are written and fsynced in batches by a background
+    thread, so that recording a change never waits for the disk; whatever
+    is recorded while one batch is being synced goes into the next.
+    flush_journal() waits until everything recorded so far is durable.
+    """
+    HASH_BUFSIZE = 1024 * 1024
+    jobs = 4
+
+    def __init__(self, folder, jobs=None):
+        self.dir = folder
+        self.path = os.path.join(folder, '.servermods.json')
+        self.journal_path = os.path.join(folder, '.servermods.journal')
+        self.file_lock = FileLock(os.path.join(folder, '.servermods.lock'))
+        if jobs is not None:
+            self.jobs = jobs
+        self.lock = threading.Lock()
+        self.saved = None
+        self.snapshot = None
+        self.last_diff = None
+        self.journal_cond = threading.Condition()
+        self.journal_pending = []
+        self.journal_queued = 0
+        self.journal_written = 0
+        self.journal_error = None
+        self.journal_thread = None
+        self.hash_keys = None  # filename -> set of hash_index keys
+        self.load()
+
+    @property
+    def own_files(self):
+        return set(os.path.basename(path) for path in [
+            self.path, self.journal_path, self.file_lock.path
+        ])
+
+    def load(self):
+        self.hash_keys = None
+        with self.file_lock:
+            if not os.path.exists(self.path):
+                self.data = {
+                    'version': 1,
+                    'installed': {},
+                    'apikey': None
+                }
+                self.replay_journal()
+                self.save()
+                return
+
+            with open(self.path, 'r') as f:
+                self.data = json.load(f)
+            self.saved = json.dumps(self.data)
+            if self.replay_journal():
+                # compacting it means later changes can't end up appended
+                # to a line torn by a crash, where replaying would stop
+                self.save()
+
+    def replay_journal(self):
+        """ Applies changes made since the last save(). Returns whether
+        there was a journal. """
+        return self.apply_journal(self.journal_path, self.data['installed'])
+
+    @staticmethod
+    def apply_journal(journal_path, installed):
+        """ Applies the changes in a journal to a dict of installed
+        entries. Returns whether there was a journal. """
+        try:
+            f = open(journal_path, 'r')
+        except (IOError, OSError):
+            return False  # nothing's changed
+        with f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break  # we crashed halfway through writing this one
+                if entry['op'] == 'installed':
+                    installed[entry['id']] = entry['data']
+                elif entry['op'] == 'removed':
+                    installed.pop(entry['id'], None)
+        return True
+
+    @classmethod
+    def read_installed(clz, folder):
+        """ The installed entries of the database in folder, including
+        whatever's still only in its journal, without loading it (which
+        would write it back out). Raises IOError (or OSError) if there's no
+        database there, or ValueError if it's unreadable. """
+        with open(os.path.join(folder, '.servermods.json'), 'r') as f:
+            installed = json.load(f)['installed']
+        clz.apply_journal(
+            os.path.join(folder, '.servermods.journal'), installed
+        )
+        return installed
+
+    def journal(self, entry):
+        """ Records one change to the installed files, which the journal
+        thread makes durable shortly afterwards """
+        line = json.dumps(entry) + '\n'
+        with self.journal_cond:
+            self.journal_pending.append(line)
+            self.journal_queued += 1
+            if self.journal_thread is None:
+                # not a daemon, so whatever's pending still gets written if
+                # we're exiting
+                self.journal_thread = threading.Thread(
+                    target=self._write_journal
+                )
+                self.journal_thread.start()
+
+    def _write_journal(self):
+        while True:
+            with self.journal_cond:
+                lines = self.journal_pending
+                if len(lines) == 0:
+                    self.journal_thread = None
+                    return
+                self.journal_pending = []
+
+            error = None
+            try:
+                with self.file_lock:
+                    with open(self.journal_path, 'a') as f:
+                        f.write(''.join(lines))
+                        f.flush()
+                        os.fsync(f.fileno())
+            except (IOError, OSError) as e:
+                error = e
+
+            with self.journal_cond:
+                self.journal_written += len(lines)
+                if error is not None:
+                    self.journal_error = error
+                self.journal_cond.notify_all()
+
+    def flush_journal(self):
+        """ Waits until every change recorded so far is on disk """
+        with self.journal_cond:
+            while self.journal_written < self.journal_queued:
+                self.journal_cond.wait()
+            error, self.journal_error = self.journal_error, None
+        if error is not None:
+            raise error
+
+    def api_key():
+        doc = "The api_key property."
+
+        def fget(self):
+            return self._api_key
+
+        def fset(self, value):
+            self._api_key = value
+
+        return {'doc': doc, 'fget': fget, 'fset': fset}
+    api_key = property(**api_key())
+
+    def save(self):
+        """ Atomically writes out the whole database, which makes the
+        journal redundant. Nothing's written if nothing has changed, which
+        leaves the directory's mtime (see DirectorySnapshot) alone. """
+        tmp_path = '{0}.{1}.tmp'.format(self.path, os.getpid())
+        # the journal thread needs file_lock too, so wait for it first
+        self.flush_journal()
+        with self.file_lock:
+            with self.lock:
+                serialised = json.dumps(self.data)
+            if serialised == self.saved and \
+                    not os.path.exists(self.journal_path):
+                return self
+            with open(tmp_path, 'w') as f:
+                f.write(serialised)
+                f.flush()
+                os.fsync(f.fileno())
+            replace_file(tmp_path, self.path)
+            fsync_dir(self.dir)
+            if os.path.exists(self.journal_path):
+                os.remove(self.journal_path)
+            self.saved = serialised
+        return self
+
+    def _stat_key(self, st):
+        return "{0}:{1}:{2}".format(st.st_ino, st.st_size, mtime_ns(st))
+
+    def get_hash(self, filename, st=None):
+        """ MD5s a file in the plugins directory, reusing the digest from
+        the hash index if a file with the same inode, size and mtime has
+        been hashed before (which is also the case after a rename) """
+        import hashlib
+        path = os.path.join(self.dir, filename)
+        if st is None:
+            st = os.stat(path)
+        key = self._stat_key(st)
+
+        with self.lock:
+            hash_index = self.data.setdefault('hash_index', {})
+            indexed = hash_index.get(key)
+            if indexed is not None:
+                if indexed[0] != filename:
+                    # renamed, so it's whatever was called filename now
+                    self._forget_hashes(filename)
+                    self._hash_keys().get(indexed[0], set()).discard(key)
+                    self._hash_keys()[filename] = set([key])
+                    indexed[0] = filename
+                return indexed[1]
+
+        md5 = hashlib.md5()
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(self.HASH_BUFSIZE)
+                if not buf:
+                    break
+                md5.update(buf)
+        digest = md5.hexdigest()
+
+        self.record_hash(filename, st, digest)
+        return digest
+
+    def record_hash(self, filename, st, digest):
+        """ Adds an already known MD5 for filename to the hash index """
+        key = self._stat_key(st)
+        with self.lock:
+            # drop whatever we knew about the previous contents of this file
+            self._forget_hashes(filename)
+            self.data['hash_index'][key] = [filename, digest]
+            self._hash_keys()[filename] = set([key])
+
+    def _hash_keys(self):
+        """ Maps filenames to their keys in the hash index, so that
+        updating it doesn't mean going through the whole thing. Only call
+        this with self.lock held. """
+        if self.hash_keys is None:
+            self.hash_keys = {}
+            for key, (fn, digest) in self.data.setdefault(
+                    'hash_index', {}).items():
+                self.hash_keys.setdefault(fn, set()).add(key)
+        return self.hash_keys
+
+    def _forget_hashes(self, filename):
+        hash_index = self.data.setdefault('hash_index', {})
+        for key in self._hash_keys().pop(filename, ()):
+            hash_index.pop(key, None)
+
+    def installed(self, mod, file, filename, digests=None):
+        """ Records that file has been saved as filename. digests is an
+        optional dict of hashlib algorithm -> hex digest computed while
+        downloading, which saves reading the file back in again """
+        st = os.stat(os.path.join(self.dir, filename))
+        if digests is not None and 'md5' in digests:
+            self.record_hash(filename, st, digests['md5'])
+            md5 = digests['md5']
+        else:
+            md5 = self.get_hash(filename, st)
+        store_data = {
+            'server_mod_id': mod.id,
+            'server_mod_name': mod.name,
+            'filename': filename,
+            'file_version': file.name,
+            'download_url': file.download_url,
+            'hash': md5,
+            'size': st.st_size
+        }
+        if digests is not None:
+            store_data['digest'] = primary_digest(digests)
+        return self.record(store_data)
+
+    def record(self, store_data):
+        """ Records an installed entry, as installed() builds them """
+        server_mod_id = str(store_data['server_mod_id'])
+        self.data['installed'][server_mod_id] = store_data
+        self.journal({
+            'op': 'installed', 'id': server_mod_id, 'data': store_data
+        })
+        return self
+
+    def removed(self, mod, file):
+        del self.data['installed'][str(mod.id)]
+        self.journal({'op': 'removed', 'id': str(mod.id)})
+        return self
+
+    def scan(self):
+        """ Lists the plugins directory, from the last run's listing if
+        nothing's changed since """
+        self.snapshot = DirectorySnapshot(
+            self.dir, os.path.join(self.dir, '.servermods-cache', 'scan.json')
+        ).scan()
+        return self.snapshot
+
+    def diff(self):
+        """ Works out what has happened to the installed files since they
+        were recorded, without changing the records. Returns a dict of
+        'renamed', a list of {'server_mod_id', 'from', 'to'}, and 'lost', a
+        list of {'server_mod_id', 'filename'} for files which are gone. """
+        snapshot = self.scan()
+        names = snapshot.names
+
+        lost_files = {}
+        known_files = set()
+        for data in self.get_data().values():
+            if data['filename'] in names:
+                known_files.add(data['filename'])
+            else:
+                lost_files.setdefault(data['hash'], []).append(data)
+
+        # older databases don't know file sizes, so we can't rule anything
+        # out by size for those
+        lost_sizes = set(
+            data.get('size') for lost in lost_files.values() for data in lost
+        )
+
+        # now check to see if they just renamed the file to confuse me
+        own_files = self.own_files
+        candidates = []
+        for fn, is_file in names.items():
+            if len(lost_files) == 0:
+                break
+            if fn in known_files or fn in own_files:
+                continue
+            if not is_file:
+                continue  # plugins keep their config in subdirectories
+            if fn.endswith('.part') or fn.endswith('.tmp'):
+                continue  # an unfinished download
+            try:
+                st = snapshot.stat(fn)
+            except OSError:
+                continue
+            if None not in lost_sizes and st.st_size not in lost_sizes:
+                continue  # can't possibly be one of the lost files
+            candidates.append((fn, st))
+
+        # md5 hash whatever's left
+        renamed = []
+        pool = WorkerPool(self.jobs)
+        hashed = pool.imap_unordered(lambda c: self.get_hash(*c), candidates)
+        for (fn, st), md5, error in hashed:
+            if error is not None:
+                continue  # went away while we were looking at it
+            if lost_files.get(md5):
+                # identified!
+                data = lost_files[md5].pop(0)
+                renamed.append({
+                    'server_mod_id': data['server_mod_id'],
+                    'from': data['filename'],
+                    'to': fn
+                })
+
+        lost = [
+            {'server_mod_id': data['server_mod_id'],
+             'filename': data['filename']}
+            for datas in lost_files.values() for data in datas
+        ]
+        return {
+            'renamed': sorted(renamed, key=lambda z: z['to']),
+            'lost': sorted(lost, key=lambda z: z['filename'])
+        }
+
+    def apply(self, diff):
+        """ Updates the records with a diff() """
+        dataset = self.get_data()
+        for change in diff['lost']:
+            del dataset[str(change['server_mod_id'])]
+        for change in diff['renamed']:
+            dataset[str(change['server_mod_id'])]['filename'] = change['to']
+
+        # forget about hashes of files which no longer exist
+        names = self.snapshot.names
+        with self.lock:
+            for fn in list(self._hash_keys()):
+                if fn not in names:
+                    self._forget_hashes(fn)
+
+        return self
+
+    def recheck(self):
+        """ Applies whatever diff() finds, which is kept as last_diff """
+        self.last_diff = self.diff()
+        return self.apply(self.last_diff)
+
+    def get_data(self):
+        return self.data['installed']
+
+
+class ContentStore(object):
+    """ Files kept by their digest under objects/<algorithm>/<xx>/<hex>,
+    so that each one is only stored once however many times it's added,
+    plus an index.json which the subclass decides the contents of. The
+    index is locked against other threads and processes while it's being
+    read and written. """
+    empty_index = {}
+
+    def __init__(self, folder, link_method='auto'):
+        self.dir = folder
+        self.index_path = os.path.join(folder, 'index.json')
+        self.link_method = link_method
+        self.lock = FileLock(os.path.join(folder, '.lock'))
+
+    def _locked(self):
+        # locks the index against other threads and processes
+        return self.lock
+
+    def _load_index(self):
+        try:
+            with open(self.index_path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return json.loads(json.dumps(self.empty_index))  # a fresh copy
+
+    def _save_index(self, index):
+        tmp_path = self.index_path + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(index, f)
+        replace_file(tmp_path, self.index_path)
+
+    def object_path(self, digest):
+        algorithm, hexdigest = digest.split(':', 1)
+        return os.path.join(
+            self.dir, 'objects', algorithm, hexdigest[:2], hexdigest
+        )
+
+    def put(self, path, digest):
+        """ Keeps the file at path as the object with digest, hardlinking
+        it where possible """
+        object_path = self.object_path(digest)
+        if os.path.exists(object_path):
+            return
+        if not os.path.isdir(os.path.dirname(object_path)):
+            try:
+                os.makedirs(os.path.dirname(object_path))
+            except OSError:
+                pass  # someone else beat us to it
+        tmp_path = '{0}.{1}.tmp'.format(
+            object_path, threading.current_thread().ident
+        )
+        link_or_copy(path, tmp_path, self.link_method)
+        replace_file(tmp_path, object_path)
+
+    def get(self, digest, path):
+        """ Atomically places the object with digest at path """
+        place_file(self.object_path(digest), path, self.link_method)
+
+    def remove_objects(self, keep):
+        """ Deletes every object whose digest isn't in keep. Returns
+        (objects removed, bytes freed). """
+        removed = 0
+        freed = 0
+        objects_dir = os.path.join(self.dir, 'objects')
+        for root, _, filenames in os.walk(objects_dir):
+            for fn in filenames:
+                algorithm = os.path.relpath(root, objects_dir).split(
+                    os.sep
+                )[0]
+                if algorithm + ':' + fn in keep:
+                    continue
+                path = os.path.join(root, fn)
+                freed += os.path.getsize(path)
+                os.remove(path)
+                removed += 1
+        return removed, freed
+
+
+class ArtifactStore(ContentStore):
+    """ Content-addressed store of downloaded files which can be shared
+    between several plugins directories.
+
+    index.json remembers which download URL produced which object, and
+    which plugins directories use the store. Since every directory's
+    CLIStorage records the digest of each installed file, gc() can work
+    out how many references each object has left. Objects staged for a
+    directory but not installed yet count as references too, until they
+    are installed there or are older than staged_max_age seconds.
+    """
+    empty_index = {'urls': {}, 'dirs': [], 'staged': []}
+    staged_max_age = 7 * 24 * 60 * 60
+
+    def __init__(self, folder, link_method='auto'):
+        if not os.path.isdir(folder):
+            os.makedirs(folder)
+        ContentStore.__init__(self, folder, link_method)
+
+    def register(self, plugins_dir):
+        with self._locked():
+            index = self._load_index()
+            if plugins_dir not in index['dirs']:
+                index['dirs'].append(plugins_dir)
+                self._save_index(index)
+
+    def lookup(self, url):
+        """ Returns the digests (as from download()) of the object that was
+        downloaded from url, or None if we don't have it """
+        with self._locked():
+            digests = self._load_index()['urls'].get(url)
+        if digests is None:
+            return None
+        if not os.path.exists(self.object_path(primary_digest(digests))):
+            return None
+        return digests
+
+    def add(self, path, url, digests, staged_for=None):
+        """ Puts the file at path into the store. If it's an update that's
+        been staged for the plugins directory staged_for, gc() keeps it
+        until it's been installed there. """
+        self.put(path, primary_digest(digests))
+
+        with self._locked():
+            index = self._load_index()
+            index['urls'][url] = digests
+            self._save_index(index)
+            if staged_for is not None:
+                self.mark_staged(url, digests, staged_for)
+
+    def mark_staged(self, url, digests, plugins_dir):
+        """ Records that the object downloaded from url is waiting to be
+        installed into plugins_dir """
+        import time
+        with self._locked():
+            index = self._load_index()
+            staged = [
+                z for z in index.get('staged', [])
+                if (z['url'], z['dir']) != (url, plugins_dir)
+            ]
+            staged.append({
+                'url': url,
+                'dir': plugins_dir,
+                'digest': primary_digest(digests),
+                'time': time.time(),
+            })
+            index['staged'] = staged
+            self._save_index(index)
+
+    def checkout(self, digests, path):
+        """ Atomically places the object with these digests at path """
+        self.get(primary_digest(digests), path)
+
+    def gc(self):
+        """ Deletes objects no registered plugins directory refers to,
+        either by having them installed or staged. Returns (objects removed,
+        bytes freed). """
+        import time
+        now = time.time()
+        with self._locked():
+            index = self._load_index()
+            refs = {}
+            dirs = []
+            installed_digests = {}  # plugins directory -> set of digests
+            for plugins_dir in index['dirs']:
+                try:
+                    # journaled installs are references too, even if they
+                    # haven't been saved yet
+                    installed = CLIStorage.read_installed(plugins_dir)
+                except (IOError, OSError, ValueError):
+                    continue  # that plugins directory has gone away
+                dirs.append(plugins_dir)
+                installed_digests[plugins_dir] = set()
+                for data in installed.values():
+                    if 'digest' in data:
+                        refs[data['digest']] = refs.get(data['digest'], 0) + 1
+                        installed_digests[plugins_dir].add(data['digest'])
+
+            # staged updates are references until they've been installed
+            # (when the directory refers to them itself) or have expired
+            staged = []
+            for entry in index.get('staged', []):
+                if entry['dir'] not in installed_digests or \
+                        entry['digest'] in installed_digests[entry['dir']] \
+                        or now - entry['time'] > self.staged_max_age:
+                    continue
+                staged.append(entry)
+                refs[entry['digest']] = refs.get(entry['digest'], 0) + 1
+
+            removed, freed = self.remove_objects(set(refs))
+
+            index['dirs'] = dirs
+            index['staged'] = staged
+            index['urls'] = dict(
+                (url, digests) for url, digests in index['urls'].items()
+                if primary_digest(digests) in refs
+            )
+            self._save_index(index)
+
+        return removed, freed
+
+
+class JarHistory(ContentStore):
+    """ Keeps the JARs that updates replace, so they can be rolled back
+    without going anywhere near the network.
+
+    Each snapshot is the installed entry from CLIStorage plus the time it
+    was replaced, and its file is kept as an object (hardlinked where
+    possible, so taking a snapshot is nearly free), which means every
+    version is only kept once. Snapshots older than max_age seconds go
+    first, then the oldest ones until the objects they use fit into
+    max_size bytes. The folder only gets created once there's something
+    to keep in it.
+    """
+    empty_index = {'snapshots': []}
+    max_size = 256 * 1024 * 1024
+    max_age = 30 * 24 * 60 * 60
+
+    def __init__(self, folder, max_size=None, max_age=None,
+                 link_method='auto'):
+        ContentStore.__init__(self, folder, link_method)
+        if max_size is not None:
+            self.max_size = max_size
+        if max_age is not None:
+            self.max_age = max_age
+
+    @classmethod
+    def default_dir(clz, plugins_dir):
+        return os.path.join(plugins_dir, '.servermods-history')
+
+    def digest(self, data):
+        return data.get('digest') or 'md5:' + data['hash']
+
+    def snapshots(self, server_mod_id=None):
+        """ Snapshots, newest first """
+        if not os.path.isdir(self.dir):
+            return []
+        with self._locked():
+            snapshots = self._load_index()['snapshots']
+        if server_mod_id is not None:
+            snapshots = [
+                z for z in snapshots
+                if str(z['server_mod_id']) == str(server_mod_id)
+            ]
+        return sorted(snapshots, key=lambda z: z['replaced'], reverse=True)
+
+    def snapshot(self, plugins_dir, entries, protect=()):
+        """ Keeps the files of the given CLIStorage entries, which are
+        about to be replaced. Snapshots with the digests in protect are
+        never evicted to make room, e.g. because they're being restored. """
+        import time
+        entries = [
+            data for data in entries
+            if os.path.exists(os.path.join(plugins_dir, data['filename']))
+        ]
+        if len(entries) == 0:
+            return
+        if not os.path.isdir(self.dir):
+            os.makedirs(self.dir)
+
+        now = time.time()
+        with self._locked():
+            index = self._load_index()
+            for data in entries:
+                self.put(
+                    os.path.join(plugins_dir, data['filename']),
+                    self.digest(data)
+                )
+                snapshot = dict(data)
+                snapshot['replaced'] = now
+                index['snapshots'].append(snapshot)
+            self._evict(index, now, protect)
+            self._save_index(index)
+
+    def restore(self, snapshot, path):
+        """ Atomically puts the file from snapshot at path """
+        self.get(self.digest(snapshot), path)
+
+    def _evict(self, index, now, protect=()):
+        protect = set(protect)
+        snapshots = sorted(index['snapshots'], key=lambda z: z['replaced'])
+        snapshots = [
+            z for z in snapshots if now - z['replaced'] <= self.max_age or
+            self.digest(z) in protect
+        ]
+
+        sizes = {}
+        for z in snapshots:
+            digest = self.digest(z)
+            if z.get('size') is not None:
+                sizes[digest] = z['size']
+            elif os.path.exists(self.object_path(digest)):
+                sizes[digest] = os.path.getsize(self.object_path(digest))
+
+        def total_size(snapshots):
+            return sum(sizes.get(digest, 0) for digest in set(
+                self.digest(z) for z in snapshots
+            ))
+
+        evictable = [z for z in snapshots if self.digest(z) not in protect]
+        while len(evictable) > 0 and total_size(snapshots) > self.max_size:
+            snapshots.remove(evictable.pop(0))
+        index['snapshots'] = snapshots
+
+        # delete whatever objects nothing refers to any more
+        self.remove_objects(set(self.digest(z) for z in snapshots))
+
+
+class DownloadProgress(object):
+    """ Aggregates the progress of several concurrent downloads """
+
+    def __init__(self, client, total_files):
+        import time
+        self.client = client
+        self.start = time.time()
+        self.total_files = total_files
+        self.finished_files = 0
+        self.positions = {}
+        self.sizes = {}
+        self.starts = {}
+        self.lock = threading.Lock()
+
+    def __call__(self, file, position, size):
+        with self.lock:
+            if position != -1 and size != -1:
+                # resumed downloads start part way, which isn't throughput
+                self.starts.setdefault(id(file), position)
+                self.positions[id(file)] = position
+                self.sizes[id(file)] = size
+            self.render()
+
+    def finished(self, file):
+        with self.lock:
+            self.finished_files += 1
+            if id(file) in self.sizes:
+                self.positions[id(file)] = self.sizes[id(file)]
+            self.render()
+
+    def throughput(self):
+        """ Bytes per second transferred so far """
+        import time
+        elapsed = time.time() - self.start
+        if elapsed <= 0:
+            return 0.0
+        transferred = sum(self.positions.values()) - sum(self.starts.values())
+        return transferred / elapsed
+
+    def render(self):
+        position = sum(self.positions.values())
+        size = sum(self.sizes.values())
+        if size == 0:
+            str_progress = "starting..."
+        else:
+            str_progress = "{0}% of {1} KiB at {2} KiB/s".format(
+                int((position * 100.0) / size), size // 1024,
+                int(self.throughput() // 1024)
+            )
+        self.client.print_status("[{0}/{1}] Downloading: {2}".format(
+            self.finished_files, self.total_files, str_progress
+        ))
+
+
+class UpdateWatcher(object):
+    """ Checks one plugins directory for updates every `interval` seconds
+    (give or take `jitter`, as a fraction of it) from a long running
+    process, reusing the client's API session and caches between polls.
+
+    Hooks added with add_hook(func) get called with a dict describing each
+    event: 'rechecked' when installed files have been renamed or removed,
+    'updates_available' when new versions first show up, 'staged'
+    once they have been downloaded into the client's ArtifactStore,
+    'installed' when they've been put into the plugins directory, and
+    'error' if a poll failed.
+    """
+
+    def __init__(self, client, plugins_dir, interval=3600, jitter=0.1,
+                 stage=True, install=False):
+        self.client = client
+        self.plugins_dir = plugins_dir
+        self.interval = interval
+        self.jitter = jitter
+        self.stage = stage
+        self.install = install
+        self.hooks = []
+        self.announced = {}  # project ID -> newest download URL we've seen
+
+    def add_hook(self, func):
+        self.hooks.append(func)
+
+    def emit(self, event, **data):
+        import time
+        data['event'] = event
+        data['plugins_dir'] = self.plugins_dir
+        data['time'] = time.time()
+        for hook in self.hooks:
+            hook(data)
+
+    def describe(self, data, f):
+        return {
+            'server_mod_id': data['server_mod_id'],
+            'server_mod_name': data['server_mod_name'],
+            'from_version': data['file_version'],
+            'to_version': f.name,
+            'download_url': f.download_url,
+        }
+
+    def poll(self):
+        client = self.client
+        api = client.api
+
+        storage = client._get_storage(self.plugins_dir)
+        storage.recheck().save()
+        if storage.last_diff['renamed'] or storage.last_diff['lost']:
+            self.emit('rechecked', **storage.last_diff)
+        installed = storage.get_data()
+        if len(installed) == 0:
+            return
+
+        # make the API ask again; the response cache turns that into a cheap
+        # revalidation if nothing has changed
+        api.forget_files(installed.keys())
+        latest = client.resolve_latest(
+            client.constraints_for(self.plugins_dir), installed.keys()
+        )
+        up_to_date, files_to_fetch, lacking_jars = client._plan_updates(
+            installed, latest
+        )
+
+        new = [
+            (data, f) for data, f in files_to_fetch
+            if self.announced.get(data['server_mod_id']) != f.download_url
+        ]
+        for data, f in files_to_fetch:
+            self.announced[data['server_mod_id']] = f.download_url
+        if len(new) > 0:
+            self.emit('updates_available', updates=[
+                self.describe(data, f) for data, f in new
+            ])
+
+        if self.stage and len(new) > 0:
+            staged = self.stage_files(new)
+            self.emit('staged', updates=[
+                self.describe(data, f) for data, f in staged
+            ])
+
+        if self.install and len(files_to_fetch) > 0:
+            failed = client.download_all([
+                (f.server_mod, f, data['filename'])
+                for data, f in files_to_fetch
+            ], into=self.plugins_dir, storage=storage)
+            storage.save()
+            failed_ids = set(mod.id for mod, error in failed)
+            self.emit('installed', updates=[
+                self.describe(data, f) for data, f in files_to_fetch
+                if data['server_mod_id'] not in failed_ids
+            ], failed=[
+                {'server_mod_id': mod.id, 'error': str(error)}
+                for mod, error in failed
+            ])
+
+    def stage_files(self, files_to_fetch):
+        """ Downloads files into the store without installing them """
+        client = self.client
+        store = client.store
+        store.register(self.plugins_dir)
+        staging_dir = os.path.join(store.dir, 'staging')
+        if not os.path.isdir(staging_dir):
+            os.makedirs(staging_dir)
+
+        def stage(item):
+            data, f = item
+            digests = store.lookup(f.download_url)
+            if digests is not None:
+                store.mark_staged(f.download_url, digests, self.plugins_dir)
+                return
+            fn = '{0}-{1}'.format(data['server_mod_id'], f.file_name)
+            fn, digests = client.api.scheduler.call(
+                f.download_url, lambda: client.download(
+                    file=f, into=staging_dir, fn=fn,
+                    progress=lambda *args: None
+                )
+            )
+            path = os.path.join(staging_dir, fn)
+            store.add(
+                path, f.download_url, digests, staged_for=self.plugins_dir
+            )
+            os.remove(path)
+
+        staged = []
+        pool = WorkerPool(client.jobs)
+        for item, _, error in pool.imap_unordered(stage, files_to_fetch):
+            if error is not None:
+                self.emit('error', error=str(error),
+                          update=self.describe(*item))
+            else:
+                staged.append(item)
+        return staged
+
+    def run(self, count=None):
+        """ Polls forever, or count times """
+        import random
+        import time
+        polls = 0
+        while True:
+            try:
+                self.poll()
+            except Exception as e:
+                self.emit('error', error=str(e))
+            polls += 1
+            if count is not None and polls >= count:
+                return
+            time.sleep(max(0, self.interval * (
+                1 + random.uniform(-self.jitter, self.jitter)
+            )))
+
+
+class LazyArgumentParser(object):
+    """ Stands in for a sub-command's argparse.ArgumentParser, which only
+    gets built (and has its arguments added by populate) the first time
+    anything asks it for something """
+
+    def __init__(self, populate=None, **kwargs):
+        self.populate = populate
+        self.kwargs = kwargs
+        self.parser = None
+
+    def get_parser(self):
+        if self.parser is None:
+            import argparse
+            self.parser = argparse.ArgumentParser(**self.kwargs)
+            if self.populate is not None:
+                self.populate(self.parser)
+        return self.parser
+
+    def __getattr__(self, name):
+        if name in ('populate', 'kwargs', 'parser'):
+            raise AttributeError(name)  # not set up yet
+        return getattr(self.get_parser(), name)
+
+
+class CommandLineClient(object):
+    BUFSIZE = 64 * 1024
+    DEFAULT_JOBS = 4
+    DEFAULT_HASH_ALGORITHM = 'sha256'
+
+    def __init__(self, api_cls=ServerModAPI):
+        try:
+            import argparse
+        except ImportError:
+            raise Exception("Please upgrade to Python 2.7+ to use this tool.")
+
+        self.api_cls = api_cls
+        self.jobs = self.DEFAULT_JOBS
+        self.hash_algorithm = self.DEFAULT_HASH_ALGORITHM
+        self.resume_downloads = True
+        self.store = None
+        self.link_method = 'auto'
+        self.bandwidth = BandwidthLimiter()
+        self.priority = set()
+        self.history_size = JarHistory.max_size
+        self.history_age = JarHistory.max_age
+        self.constraints = Constraints()
+        self.dir_constraints = {}  # plugins directory -> Constraints
+
+        self.parser = parser = argparse.ArgumentParser()
+        parser.add_argument(
+            '--verbose', action='store_true',
+            help='output more debugging messages'
+        )
+        parser.add_argument(
+            '--plugins-dir',
+            help='plugins directory to download files into', nargs='?'
+        )
+        parser.add_argument(
+            '--api-key',
+            help='Server Mod API key from ' +
+            'https://dev.bukkit.org/home/servermods-apikey/',
+            nargs='?'
+        )
+        parser.add_argument(
+            '--cache', action='store_true',
+            help='keep API responses in a persistent cache between runs'
+        )
+        parser.add_argument(
+            '--cache-dir',
+            help='where to keep the --cache and slug index (default: ' +
+            '$XDG_CACHE_HOME/servermods or PLUGINS_DIR/.servermods-cache)',
+            nargs='?'
+        )
+        parser.add_argument(
+            '--hash-algorithm', default=self.DEFAULT_HASH_ALGORITHM,
+            help='hashlib algorithm to checksum downloads with, on top of ' +
+            'MD5 (default: {0})'.format(self.DEFAULT_HASH_ALGORITHM)
+        )
+        parser.add_argument(
+            '--no-resume', action='store_false', dest='resume',
+            help='always download files from scratch instead of resuming ' +
+            'interrupted downloads'
+        )
+        parser.add_argument(
+            '--store',
+            help='shared directory to keep downloaded files in, so that ' +
+            'several plugins directories only download each file once',
+            nargs='?'
+        )
+        parser.add_argument(
+            '--link', default='auto',
+            choices=['auto', 'hardlink', 'reflink', 'copy'],
+            help='how to put files from the --store (or fleet-update\'s ' +
+            'first folder) into other plugins directories (default: auto)'
+        )
+        parser.add_argument(
+            '--profile', action='store_true',
+            help='print how long each phase of the command took'
+        )
+        parser.add_argument(
+            '--metrics',
+            help='write request and download metrics to this file',
+            nargs='?'
+        )
+        parser.add_argument(
+            '--metrics-format', default='json', choices=['json', 'prometheus'],
+            help='format of the --metrics file (default: json)'
+        )
+        parser.add_argument(
+            '--rate', type=float,
+            help='most requests per second to make to each host ' +
+            '(default: unlimited unless the server asks us to slow down)'
+        )
+        parser.add_argument(
+            '--retries', type=int, default=4,
+            help='how many times to retry failed requests (default: 4)'
+        )
+        parser.add_argument(
+            '--jobs', '-j', type=int, default=self.DEFAULT_JOBS,
+            help='number of files to download at once (default: {0})'.format(
+                self.DEFAULT_JOBS
+            )
+        )
+        parser.add_argument(
+            '--connections-per-host', type=int,
+            help='most connections to keep open to each host (default: ' +
+            'the same as --jobs)'
+        )
+        parser.add_argument(
+            '--http2', action='store_true',
+            help='download files over HTTP/2, which needs httpx[http2]'
+        )
+        parser.add_argument(
+            '--bandwidth', type=parse_rate,
+            help='most bytes per second to download at in total, e.g. 2M ' +
+            '(default: unlimited)'
+        )
+        parser.add_argument(
+            '--transfer-bandwidth', type=parse_rate,
+            help='most bytes per second to download each file at, e.g. ' +
+            '512K (default: unlimited)'
+        )
+        parser.add_argument(
+            '--history-size', type=parse_size,
+            default=JarHistory.max_size,
+            help='most bytes of replaced JARs to keep for rollback, e.g. ' +
+            '100M, or 0 to keep none (default: 256M)'
+        )
+        parser.add_argument(
+            '--history-days', type=float,
+            default=JarHistory.max_age / (24 * 60 * 60),
+            help='days to keep replaced JARs for rollback (default: 30)'
+        )
+        parser.add_argument(
+            '--game-version',
+            help='only install files for this game version, e.g. ' +
+            '"CB 1.7.2-R0.3", or "CB 1.7" for any build of 1.7'
+        )
+        parser.add_argument(
+            '--release-type', action='append',
+            choices=['release', 'beta', 'alpha'],
+            help='only install files of this release type (can be given ' +
+            'more than once; default: any)'
+        )
+        parser.add_argument(
+            '--pin', action='append', metavar='ID=VERSION',
+            help='keep the server mod with this ID at the file with this ' +
+            'name or file name (can be given more than once)'
+        )
+        parser.add_argument(
+            '--priority', action='append', metavar='SLUG',
+            help='download this server mod before any others, e.g. for a ' +
+            'security fix (can be given more than once)'
+        )
+
+        # each sub-command's arguments are only added if it's the one being
+        # run, which keeps startup quick
+        subparsers = parser.add_subparsers(
+            help='sub-command help', parser_class=LazyArgumentParser
+        )
+        subparsers.add_parser(
+            'search', help='search for a server mod',
+            populate=self.add_search_arguments
+        )
+        subparsers.add_parser(
+            'install', help='install a server mod',
+            populate=self.add_install_arguments
+        )
+        subparsers.add_parser(
+            'update', help='update all your server mods',
+            populate=self.add_update_arguments
+        )
+        subparsers.add_parser(
+            'plan', help='work out what update would do, and save it to ' +
+            'a file for apply',
+            populate=self.add_plan_arguments
+        )
+        subparsers.add_parser(
+            'apply', help='carry out a plan made by plan, without asking ' +
+            'the API anything',
+            populate=self.add_apply_arguments
+        )
+        subparsers.add_parser(
+            'fleet-update', help='update the server mods in several ' +
+            'plugins directories at once',
+            populate=self.add_fleet_update_arguments
+        )
+        subparsers.add_parser(
+            'watch', help='keep checking for updates, without asking ' +
+            'any questions',
+            populate=self.add_watch_arguments
+        )
+        subparsers.add_parser(
+            'rollback', help='put back the versions of server mods that ' +
+            'were there before they were last updated',
+            populate=self.add_rollback_arguments
+        )
+        subparsers.add_parser(
+            'store-gc', help='delete files from the --store which no ' +
+            'plugins directory uses any more',
+            populate=self.add_store_gc_arguments
+        )
+
+    def add_search_arguments(self, parser):
+        parser.add_argument(
+            'query', help='search terms (e.g. the server mods\' name' +
+            ' - "My Favourite Plugin")', nargs='+')
+        parser.set_defaults(func=self.cmd_search)
+
+    def add_install_arguments(self, parser):
+        parser.add_argument(
+            'slug', help='server mod slugs to install', nargs='+'
+        )
+        parser.add_argument(
+            '--yes', '-y', action='store_true',
+            help='don\'t ask first, and start each download as soon as ' +
+            'we know which file it is'
+        )
+        parser.set_defaults(func=self.cmd_install)
+
+    def add_update_arguments(self, parser):
+        parser.set_defaults(func=self.cmd_update)
+
+    def add_plan_arguments(self, parser):
+        parser.add_argument(
+            'output', help='file to write the plan to'
+        )
+        parser.set_defaults(func=self.cmd_plan)
+
+    def add_apply_arguments(self, parser):
+        parser.add_argument(
+            '--plan', help='plan file to apply', required=True
+        )
+        parser.set_defaults(func=self.cmd_apply)
+
+    def add_fleet_update_arguments(self, parser):
+        parser.add_argument(
+            'plugins_dirs', help='plugins directories to update', nargs='*'
+        )
+        parser.add_argument(
+            '--manifest', help='file listing plugins directories to ' +
+            'update, one per line', nargs='?'
+        )
+        parser.set_defaults(func=self.cmd_fleet_update)
 
-        self.parser = parser = argparse.ArgumentParser()
+    def add_watch_arguments(self, parser):
         parser.add_argument(
-            '--verbose', action='store_true',
-            help='output more debugging messages'
+            '--interval', type=float, default=3600,
+            help='seconds between checks (default: 3600)'
         )
         parser.add_argument(
-            '--plugins-dir',
-            help='plugins directory to download files into', nargs='?'
+            '--jitter', type=float, default=0.1,
+            help='randomly vary the interval by up to this fraction of it ' +
+            '(default: 0.1)'
         )
         parser.add_argument(
-            '--api-key',
-            help='Server Mod API key from ' +
-            'https://dev.bukkit.org/home/servermods-apikey/',
-            nargs='?'
+            '--no-stage', action='store_false', dest='stage',
+            help='don\'t download updates into the --store ahead of time'
         )
-
-        subparsers = parser.add_subparsers(help='sub-command help')
-
-        parser_search = subparsers.add_parser(
-            'search', help='search for a server mod'
+        parser.add_argument(
+            '--install', action='store_true',
+            help='install updates as soon as they turn up'
         )
-        parser_search.add_argument(
-            'query', help='search terms (e.g. the server mods\' name' +
-            ' - "My Favourite Plugin")', nargs='+')
-        parser_search.set_defaults(func=self.cmd_search)
-
-        parser_install = subparsers.add_parser(
-            'install', help='install a server mod'
+        parser.add_argument(
+            '--hook', help='shell command to run for each event, with the ' +
+            'event as JSON on its standard input', nargs='?'
         )
-        parser_install.add_argument(
-            'slug', help='server mod slugs to install', nargs='+'
+        parser.add_argument(
+            '--count', type=int,
+            help='stop after checking this many times', nargs='?'
         )
-        parser_install.set_defaults(func=self.cmd_install)
+        parser.set_defaults(func=self.cmd_watch)
 
-        parser_update = subparsers.add_parser(
-            'update', help='update all your server mods'
+    def add_rollback_arguments(self, parser):
+        parser.add_argument(
+            'mods', help='server mods to roll back, by file name (without ' +
+            '.jar), name or ID', nargs='*'
+        )
+        parser.add_argument(
+            '--list', action='store_true',
+            help='list the versions we can roll back to'
         )
-        parser_update.set_defaults(func=self.cmd_update)
+        parser.set_defaults(func=self.cmd_rollback)
+
+    def add_store_gc_arguments(self, parser):
+        parser.set_defaults(func=self.cmd_store_gc)
 
-    def run(self):
-        args = self.parser.parse_args()
+    def run(self, argv=None):
+        args = self.parser.parse_args(argv)
         if 'func' not in args:
             self.parser.print_help()
             return
-        self.api = self._fetch_api(self._get_api_key(args))
-        args.func(args)
+        self.jobs = max(1, args.jobs)
+        self.resume_downloads = args.resume
+        self.link_method = args.link
+        self.bandwidth = BandwidthLimiter(
+            args.bandwidth, per_transfer=args.transfer_bandwidth
+        )
+        self.priority = set(p.lower() for p in args.priority or [])
+        self.history_size = int(args.history_size)
+        self.history_age = args.history_days * 24 * 60 * 60
+        try:
+            self.constraints = Constraints(
+                args.game_version, args.release_type, parse_pins(args.pin)
+            )
+        except ValueError as e:
+            self.parser.error(str(e))
+        if args.store is not None:
+            self.store = ArtifactStore(
+                os.path.abspath(args.store), link_method=self.link_method
+            )
+        self.hash_algorithm = args.hash_algorithm.lower()
+        if self.hash_algorithm == 'md5':
+            self.hash_algorithm = None
+        else:
+            try:
+                self._get_hashers()
+            except ValueError:
+                self.parser.error(
+                    "Unknown --hash-algorithm: " + args.hash_algorithm
+                )
+        self.api = self._fetch_api(
+            self._get_api_key(args), cache=self._get_cache(args),
+            scheduler=RequestScheduler(
+                rate=args.rate, max_retries=max(0, args.retries)
+            ),
+            slug_index=self._get_slug_index(args),
+            pool_per_host=args.connections_per_host, http2=args.http2
+        )
+        try:
+            args.func(args)
+        finally:
+            if self.api.slug_index is not None:
+                self.api.slug_index.save()
+            self.report_instrumentation(args)
+
+    def phase(self, name):
+        return self.api.instrumentation.phase(name)
+
+    def report_instrumentation(self, args):
+        instrumentation = self.api.instrumentation
+
+        if args.verbose and self.api.cache is not None:
+            print("Cache: {hits} hits ({revalidations} revalidated), "
+                  "{misses} misses".format(**self.api.cache.stats()))
+        if args.verbose and self.api.slug_index is not None:
+            print("Slug index: {hits} hits, {misses} misses".format(
+                **self.api.slug_index.stats()
+            ))
+
+        if args.profile:
+            print("Profile:")
+            total = 0.0
+            for name, elapsed in instrumentation.phases:
+                print(" {0:<16} {1:8.3f}s".format(name, elapsed))
+                total += elapsed
+            print(" {0:<16} {1:8.3f}s".format("total", total))
+
+        if args.metrics is not None:
+            with open(args.metrics, 'w') as f:
+                if args.metrics_format == 'prometheus':
+                    f.write(instrumentation.to_prometheus())
+                else:
+                    f.write(instrumentation.to_json())
 
     def _get_api_key(self, args):
         if 'api_key' in args:
@@ -380,18 +3102,63 @@ class CommandLineClient(object):
             )
         return storage.api_key
 
-    def _fetch_api(self, api_key):
-        return self.api_cls(api_key)
+    def _fetch_api(self, api_key, cache=None, scheduler=None,
+                   slug_index=None, pool_per_host=None, http2=None):
+        return self.api_cls(
+            api_key, cache=cache, jobs=self.jobs, scheduler=scheduler,
+            slug_index=slug_index, pool_per_host=pool_per_host, http2=http2
+        )
+
+    def _get_cache(self, args):
+        if not args.cache:
+            return None
+        cache_dir = args.cache_dir
+        if cache_dir is None:
+            plugins_dir = self.canonicalise_plugins_dir(args)
+            cache_dir = ResponseCache.default_dir(plugins_dir)
+        return ResponseCache(os.path.abspath(cache_dir))
+
+    def _get_slug_index(self, args):
+        """ The slug index lives with the --cache, but is used even without
+        it. Without a --cache-dir, we need a plugins directory to keep it
+        in. """
+        cache_dir = args.cache_dir
+        if cache_dir is None:
+            plugins_dir = os.path.abspath(args.plugins_dir or 'plugins/')
+            if not os.path.isdir(plugins_dir):
+                return None
+            cache_dir = ResponseCache.default_dir(plugins_dir)
+        return SlugIndex(
+            os.path.join(os.path.abspath(cache_dir), 'slugs.json')
+        )
 
     def _get_mods_for_query(self, queries):
-        query_mods = {}
-        for query in queries:
-            query_mods[query] = self.api.projects(query)
-        return query_mods
+        queries = list(queries)
+        results = {}
+        pool = WorkerPool(self.jobs)
+        for query, mods, error in pool.imap_unordered(self.api.projects,
+                                                      queries):
+            if error is not None:
+                raise error
+            results[query] = mods
+        # searches finish in any order, but the results go in query order
+        return OrderedDict((query, results[query]) for query in queries)
 
     def _get_mods_for_slugs(self, slugs):
-        query_mods = self._get_mods_for_query(slugs)
+        slugs = list(slugs)
         slug_mods = {}
+        slug_index = self.api.slug_index
+        unknown_slugs = []
+        for slug in slugs:
+            mod = None
+            if slug_index is not None:
+                mod = slug_index.lookup(self.api, slug)
+            if mod is None:
+                unknown_slugs.append(slug)
+            else:
+                slug_mods[slug] = mod
+
+        query_mods = self._get_mods_for_query(unknown_slugs)
         for slug, mods in query_mods.items():
             chosen_mod = None
             for mod in mods:
@@ -399,10 +3166,10 @@ class CommandLineClient(object):
                     chosen_mod = mod
                     break
             slug_mods[slug] = chosen_mod
-        return slug_mods
+        return OrderedDict((slug, slug_mods[slug]) for slug in slugs)
 
     def _get_storage(self, plugins_dir):
-        return CLIStorage(plugins_dir)
+        return CLIStorage(plugins_dir, jobs=self.jobs)
 
     def canonicalise_plugins_dir(self, args):
         # check that plugins_dir exists
@@ -452,37 +3219,268 @@ class CommandLineClient(object):
             elif ok_str == 'n' or ok_str == 'no':
                 return False
 
-    def download(self, file, into, fn, file_num=None, total_files=None):
+    def _get_download_session(self):
+        return self.api.download_session()
+
+    def download(self, file, into, fn, file_num=None, total_files=None,
+                 progress=None):
         outpath = os.path.join(into, fn)
         # download into the server mod's slug so that we overwrite previous
         # version of the same mod
 
         url = file.download_url
 
-        self.print_progress(file, -1, -1, file_num, total_files)
+        if progress is None:
+            def progress(file, position, size):
+                self.print_progress(
+                    file, position, size, file_num, total_files
+                )
+
+        progress(file, -1, -1)
+
+        import time
+
+        # download into a temporary file next to the real one, so that a
+        # running server never sees half a JAR
+        part_path = self._part_path(into, fn, url)
+        self._remove_stale_parts(into, fn, part_path)
+
+        offset = 0
+        if self.resume_downloads and os.path.exists(part_path):
+            offset = os.path.getsize(part_path)
+
+        hashes = self._get_hashers()
 
         # ok, open the session
-        resp = requests.get(url, stream=True)
-        resp.raise_for_status()
-        sock = resp.raw
-        file_size = int(resp.headers['Content-Length'])
+        session = self._get_download_session()
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={0}-'.format(offset)
+        timeout = self.api.timeout
+        resp = session.get(url, stream=True, headers=headers, timeout=timeout)
+        if offset > 0 and resp.status_code == 416:
+            # whatever we had doesn't fit the file any more, start over
+            resp.close()
+            offset = 0
+            resp = session.get(url, stream=True, timeout=timeout)
+        # a response we don't read to the end has to be closed to give its
+        # connection back to the pool (reading it to the end does that)
+        try:
+            resp.raise_for_status()
 
-        current_position = 0
-        outfile = open(outpath, 'wb')
-        while True:
-            buf = sock.read(self.BUFSIZE)
-            current_position += len(buf)
-            self.print_progress(
-                file, current_position, file_size, file_num, total_files
+            file_size = int(resp.headers.get('Content-Length', -1))
+            content_range = resp.headers.get('Content-Range', '')
+            if offset > 0 and resp.status_code == 206 and \
+                    content_range.startswith('bytes {0}-'.format(offset)):
+                total = content_range.rsplit('/', 1)[-1]
+                file_size = int(total) if total.isdigit() else -1
+                self._hash_existing(part_path, hashes)
+            else:
+                offset = 0  # the server ignored our Range header
+
+            sock = resp.raw
+            current_position = offset
+            progress(file, current_position, file_size)
+            start = time.time()
+            bandwidth = self.bandwidth
+            transfer = bandwidth.transfer()
+            with open(part_path, 'ab' if offset > 0 else 'wb') as outfile:
+                while True:
+                    buf = sock.read(bandwidth.chunk_size(self.BUFSIZE))
+                    if not buf:
+                        break
+                    bandwidth.throttle(transfer, len(buf))
+                    current_position += len(buf)
+                    for h in hashes.values():
+                        h.update(buf)
+                    progress(file, current_position, file_size)
+                    outfile.write(buf)
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        except Exception:
+            resp.close()
+            raise
+        self.api.instrumentation.record_download(
+            url, current_position - offset, time.time() - start
+        )
+
+        digests = dict((a, h.hexdigest()) for a, h in hashes.items())
+        try:
+            self.verify_download(file, current_position, file_size, digests)
+        except DownloadIntegrityError:
+            os.remove(part_path)
+            raise
+
+        replace_file(part_path, outpath)
+        fsync_dir(into)
+
+        return fn, digests
+
+    def _part_path(self, into, fn, url):
+        # partial downloads are tied to the URL they came from, so we never
+        # resume one version of a file with the bytes of another
+        import hashlib
+        url_hash = hashlib.sha1(url.encode('utf-8')).hexdigest()[:12]
+        return os.path.join(into, '.{0}.{1}.part'.format(fn, url_hash))
+
+    def _remove_stale_parts(self, into, fn, part_path):
+        prefix = '.{0}.'.format(fn)
+        for other in os.listdir(into):
+            other_path = os.path.join(into, other)
+            if other.startswith(prefix) and other.endswith('.part') and \
+                    other_path != part_path:
+                os.remove(other_path)
+
+    def _hash_existing(self, path, hashes):
+        with open(path, 'rb') as f:
+            while True:
+                buf = f.read(self.BUFSIZE)
+                if not buf:
+                    break
+                for h in hashes.values():
+                    h.update(buf)
+
+    def _get_hashers(self):
+        import hashlib
+        hashes = {'md5': hashlib.md5()}
+        if self.hash_algorithm is not None:
+            hashes[self.hash_algorithm] = hashlib.new(self.hash_algorithm)
+        return hashes
+
+    def verify_download(self, file, size, expected_size, digests):
+        if expected_size != -1 and size != expected_size:
+            raise DownloadIntegrityError(
+                file, "got {0} of {1} bytes".format(size, expected_size)
             )
-            outfile.write(buf)
-            if len(buf) < self.BUFSIZE:
-                break
+        if file.size is not None and size != file.size:
+            raise DownloadIntegrityError(
+                file, "got {0} bytes, expected {1}".format(size, file.size)
+            )
+        mismatch = self.digest_mismatch(file, digests)
+        if mismatch is not None:
+            raise DownloadIntegrityError(file, mismatch)
 
-        outfile.close()
-        print("")
+    def digest_mismatch(self, file, digests):
+        """ Describes how digests differ from what file should have, or
+        returns None if they match as far as we can tell """
+        if file.md5 is not None and file.md5.lower() != digests['md5']:
+            return "MD5 is {0}, expected {1}".format(digests['md5'], file.md5)
+        if file.digest is not None:
+            algorithm, expected = file.digest.split(':', 1)
+            actual = digests.get(algorithm)
+            if actual is not None and actual != expected.lower():
+                return "{0} is {1}, expected {2}".format(
+                    algorithm, actual, expected
+                )
+        return None
+
+    def fetch_file(self, file, into, fn, progress=None):
+        """ Like download(), but takes the file from the --store instead if
+        it's already in there """
+        store = self.store
+        if store is not None:
+            digests = store.lookup(file.download_url)
+            if digests is not None and \
+                    self.digest_mismatch(file, digests) is None:
+                store.checkout(digests, os.path.join(into, fn))
+                return fn, digests
+
+        # with resuming, a retry only fetches whatever we didn't get yet
+        fn, digests = self.api.scheduler.call(
+            file.download_url, lambda: self.download(
+                file=file, into=into, fn=fn, progress=progress
+            )
+        )
+        if store is not None:
+            store.add(os.path.join(into, fn), file.download_url, digests)
+        return fn, digests
+
+    def download_all(self, fetches, into, storage):
+        """ Downloads (mod, file, filename) triples using up to self.jobs
+        connections at once, recording each one in storage as it finishes.
+
+        Returns a list of (mod, exception) pairs for downloads that failed.
+        """
+        progress = DownloadProgress(self, len(fetches))
+        pool = WorkerPool(self.jobs)
+
+        if self.store is not None:
+            self.store.register(into)
+
+        def fetch(item):
+            mod, f, fn = item
+            return self.fetch_file(f, into=into, fn=fn, progress=progress)
+
+        # the pool starts downloads in the order it's given them
+        fetches = sorted(fetches, key=self.download_priority)
+
+        self.keep_replaced(into, storage, [f for mod, f, fn in fetches])
+
+        failed = []
+        for (mod, f, _), result, error in pool.imap_unordered(fetch, fetches):
+            progress.finished(f)
+            if error is not None:
+                failed.append((mod, error))
+                continue
+            fn, digests = result
+            storage.installed(mod=mod, file=f, filename=fn, digests=digests)
+        print("")  # leaves the final progress, and throughput, on screen
+
+        return failed
+
+    def _get_history(self, plugins_dir):
+        return JarHistory(
+            JarHistory.default_dir(plugins_dir), max_size=self.history_size,
+            max_age=self.history_age, link_method=self.link_method
+        )
+
+    def keep_replaced(self, plugins_dir, storage, files):
+        """ Snapshots whatever installing files into plugins_dir is about
+        to replace, so that it can be rolled back. Every install and update
+        path has to call this before it puts anything in place. """
+        if self.history_size == 0:
+            return
+        installed = storage.get_data()
+        replacing = []
+        for f in files:
+            data = installed.get(str(f.project_id))
+            if data is not None and data['download_url'] != f.download_url:
+                replacing.append(data)
+        self._get_history(plugins_dir).snapshot(plugins_dir, replacing)
+
+    def download_priority(self, fetch):
+        """ Sort key for (mod, file, filename) downloads: --priority server
+        mods first. After that come the smallest files, so that as many as
+        possible are done early on, but only where their sizes are known,
+        which means files from a plan; the API's listings don't give them,
+        so install and update keep their order otherwise. """
+        mod, f, fn = fetch
+        names = [mod.slug, mod.name, str(mod.id), os.path.splitext(fn)[0]]
+        prioritised = any(
+            name is not None and name.lower() in self.priority
+            for name in names
+        )
+        return (not prioritised, f.size is None, f.size or 0)
+
+    def report_recheck(self, storage):
+        """ Mentions what recheck() noticed had changed """
+        diff = storage.last_diff
+        for change in diff['renamed']:
+            print("{0} was renamed to {1}                     ".format(
+                change['from'], change['to']
+            ))
+        for change in diff['lost']:
+            print("{0} has gone, so I'll forget about it           ".format(
+                change['filename']
+            ))
 
-        return fn
+    def report_failed_downloads(self, failed):
+        if len(failed) == 0:
+            return
+        failed_str = ", ".join(
+            '"{0}" ({1})'.format(mod.name, error) for mod, error in failed
+        )
+        self.parser.error("Some server mods failed to download: " + failed_str)
 
     def clean_mods_for_slugs(self, slugs):
         mods = self._get_mods_for_slugs(slugs)
@@ -490,14 +3488,23 @@ class CommandLineClient(object):
         # could any slugs not be found?
         if None in mods.values():
             unfound = [slug for slug, mod in mods.items() if mod is None]
-            unfound_str = '"' + '", "'.join(unfound) + '"'
-            self.parser.error(
-                'Couldn\'t find the following server mods ' +
-                '(try using "search" to find their slugs): ' + unfound_str
-            )
+            self.parser.error(self.unfound_message(unfound))
 
         return mods
 
+    def unfound_message(self, slugs):
+        return (
+            'Couldn\'t find the following server mods ' +
+            '(try using "search" to find their slugs): "' +
+            '", "'.join(slugs) + '"'
+        )
+
+    def lacking_jars_message(self, slugs):
+        return (
+            'Some of those server mods have no plain JAR ' +
+            'files, so I can\'t install them: "' + '", "'.join(slugs) + '"'
+        )
+
     def cmd_search(self, args):
         self.print_status("Searching server mods...")
         mods_by_query = self._get_mods_for_query(args.query)
@@ -521,29 +3528,37 @@ class CommandLineClient(object):
         plugins_dir = self.canonicalise_plugins_dir(args)
 
         self.print_status("Loading persistent storage...")
-        storage = self._get_storage(plugins_dir)
+        with self.phase("storage load"):
+            storage = self._get_storage(plugins_dir)
+
+        if args.yes:
+            with self.phase("install"):
+                self.install_pipelined(plugins_dir, storage, args.slug)
+            return
 
         self.print_status("Fetching server mods...")
-        mods = self.clean_mods_for_slugs(args.slug)
+        with self.phase("lookup"):
+            mods = self.clean_mods_for_slugs(args.slug)
 
         # start building a list of files to download
         self.print_status("Building list of files...")
         lacking_jars = []
         files_to_fetch = []
-        self.api.files(project_ids=[m.id for m in mods.values()])
+        constraints = self.constraints_for(plugins_dir)
+        with self.phase("lookup"):
+            latest = self.api.resolve(
+                constraints, [m.id for m in mods.values()]
+            )
         for slug, mod in mods.items():
-            try:
-                f = mod.latest_file(extension='.jar')
-                files_to_fetch.append((mod, f))
-            except:
+            f = latest.get(int(mod.id))
+            if f is None:
                 lacking_jars.append(slug)
+                continue
+            f.server_mod = mod
+            files_to_fetch.append((mod, f))
 
         if len(lacking_jars) > 0:
-            lacking_jars_str = '"' + '", "'.join(lacking_jars) + '"'
-            self.parser.error(
-                'Some of those server mods have no plain JAR ' +
-                'files, so I can\'t install them: ' + lacking_jars_str
-            )
+            self.parser.error(self.lacking_jars_message(lacking_jars))
 
         # OK, it's showtime!
         print("Going to download:             ")  # spaces to clear line
@@ -559,54 +3574,144 @@ class CommandLineClient(object):
 
         print("")
 
-        n = 0
-        file_count = len(files_to_fetch)
-        for mod, f in files_to_fetch:
-            n += 1
-            fn = self.download(
-                file=f, into=plugins_dir, file_num=n, total_files=file_count,
-                fn=f.server_mod.slug + '.jar'
+        with self.phase("download"):
+            failed = self.download_all([
+                (mod, f, f.server_mod.slug + '.jar')
+                for mod, f in files_to_fetch
+            ], into=plugins_dir, storage=storage)
+
+        self.print_status("Cleaning up...")
+        with self.phase("save"):
+            storage.save()
+        self.report_failed_downloads(failed)
+
+    def install_pipelined(self, plugins_dir, storage, slugs):
+        """ Installs the latest JAR of each slug without asking first. Each
+        download starts as soon as we know which file it is, while other
+        slugs are still being looked up. """
+        slugs = list(OrderedDict.fromkeys(slugs))  # each one only once
+        progress = DownloadProgress(self, len(slugs))
+        if self.store is not None:
+            self.store.register(plugins_dir)
+
+        def resolve(slug):
+            mod = self._get_mods_for_slugs([slug])[slug]
+            if mod is None:
+                raise NoSuchServerMod(slug)
+            return mod
+
+        constraints = self.constraints_for(plugins_dir)
+
+        def choose_file(mod):
+            f = self.api.resolve(constraints, [mod.id]).get(int(mod.id))
+            if f is None:
+                raise NoSuchFile()
+            f.server_mod = mod
+            return mod, f
+
+        def download(mod_file):
+            mod, f = mod_file
+            self.keep_replaced(plugins_dir, storage, [f])
+            fn, digests = self.fetch_file(
+                f, into=plugins_dir, fn=mod.slug + '.jar', progress=progress
             )
-            storage.installed(mod=mod, file=f, filename=fn)
+            return mod, f, fn, digests
+
+        pipeline = Pipeline([
+            (resolve, self.jobs), (choose_file, self.jobs),
+            (download, self.jobs)
+        ])
+        installed = []
+        unfound = []
+        lacking_jars = []
+        failed = []
+        for slug, result, error in pipeline.run(slugs):
+            if error is None:
+                mod, f, fn, digests = result
+                storage.installed(mod=mod, file=f, filename=fn,
+                                  digests=digests)
+                installed.append((mod, f))
+                progress.finished(f)
+                continue
+            progress.finished(None)
+            if isinstance(error, NoSuchServerMod):
+                unfound.append(slug)
+            elif isinstance(error, NoSuchFile):
+                lacking_jars.append(slug)
+            else:
+                failed.append('"{0}" ({1})'.format(slug, error))
+        print("")
 
         self.print_status("Cleaning up...")
-        storage.save()
+        with self.phase("save"):
+            storage.save()
+
+        print("Installed:                     ")  # spaces to clear line
+        for mod, f in installed:
+            print(" - {0}: {1} ({2})".format(mod.name, f.name, f.release_type))
+
+        errors = []
+        if len(unfound) > 0:
+            errors.append(self.unfound_message(unfound))
+        if len(lacking_jars) > 0:
+            errors.append(self.lacking_jars_message(lacking_jars))
+        if len(failed) > 0:
+            errors.append("Some server mods failed to download: " +
+                          ", ".join(failed))
+        if len(errors) > 0:
+            self.parser.error(" ".join(errors))
+
+    def _plan_updates(self, update_queue, latest):
+        """ Sorts installed entries into up to date, needing an update and
+        lacking JARs, given the latest JAR for each project """
+        up_to_date = []
+        files_to_fetch = []
+        lacking_jars = []
+        for data in update_queue.values():
+            f = latest.get(int(data['server_mod_id']))
+            if f is None:
+                lacking_jars.append(data)
+                continue
+            if f.server_mod is None:
+                f.server_mod = ServerMod(
+                    self.api, data['server_mod_id'],
+                    name=data['server_mod_name']
+                )
+            if f.download_url == data['download_url']:
+                up_to_date.append([data, f])
+            else:
+                files_to_fetch.append([data, f])
+        return up_to_date, files_to_fetch, lacking_jars
 
     def cmd_update(self, args):
         plugins_dir = self.canonicalise_plugins_dir(args)
 
         self.print_status("Loading persistent storage...")
-        storage = self._get_storage(plugins_dir)
+        with self.phase("storage load"):
+            storage = self._get_storage(plugins_dir)
 
         update_queue = []
 
         self.print_status("Checking installed plugins...")
-        storage.recheck()
+        with self.phase("recheck"):
+            storage.recheck()
+        self.report_recheck(storage)
+        with self.phase("save"):
+            storage.save()
 
         update_queue = storage.get_data()
         self.print_status("Checking for updates...")
-        self.api.files(
-            project_ids=[m for m in update_queue.keys()]
-        )  # seed cache
+        with self.phase("lookup"):
+            latest = self.resolve_latest(
+                self.constraints_for(plugins_dir), update_queue.keys()
+            )
 
         if len(update_queue) == 0:
             self.parser.error("You don't have anything to update yet!")
 
-        up_to_date = []
-        files_to_fetch = []
-        lacking_jars = []
-        for data in update_queue.values():
-            mod = ServerMod(
-                self.api, data['server_mod_id'], name=data['server_mod_name']
-            )
-            try:
-                f = mod.latest_file(extension='.jar')
-                if f.download_url == data['download_url']:
-                    up_to_date.append([data, f])
-                else:
-                    files_to_fetch.append([data, f])
-            except:
-                lacking_jars.append(data)
+        up_to_date, files_to_fetch, lacking_jars = self._plan_updates(
+            update_queue, latest
+        )
 
         print("Summary:                ")
         if len(lacking_jars) > 0:
@@ -637,19 +3742,512 @@ class CommandLineClient(object):
         if not ok:
             return
 
-        n = 0
-        file_count = len(files_to_fetch)
+        with self.phase("download"):
+            failed = self.download_all([
+                (f.server_mod, f, data['filename'])
+                for data, f in files_to_fetch
+            ], into=plugins_dir, storage=storage)
+
+        self.print_status("Cleaning up...")
+        with self.phase("save"):
+            storage.save()
+        self.report_failed_downloads(failed)
+
+    PLAN_VERSION = 1
+
+    def _head_size(self, url):
+        session = self._get_download_session()
+
+        def head():
+            r = session.head(url, allow_redirects=True,
+                             timeout=self.api.timeout)
+            r.raise_for_status()
+            return r
+
+        size = self.api.scheduler.call(url, head).headers.get(
+            'Content-Length'
+        )
+        return int(size) if size is not None and size.isdigit() else None
+
+    def cmd_plan(self, args):
+        import time
+        plugins_dir = self.canonicalise_plugins_dir(args)
+
+        self.print_status("Loading persistent storage...")
+        with self.phase("storage load"):
+            storage = self._get_storage(plugins_dir)
+
+        self.print_status("Checking installed plugins...")
+        with self.phase("recheck"):
+            storage.recheck()
+        self.report_recheck(storage)
+        with self.phase("save"):
+            storage.save()
+
+        update_queue = storage.get_data()
+        if len(update_queue) == 0:
+            self.parser.error("You don't have anything to update yet!")
+
+        self.print_status("Checking for updates...")
+        with self.phase("lookup"):
+            latest = self.resolve_latest(
+                self.constraints_for(plugins_dir), update_queue.keys()
+            )
+        up_to_date, files_to_fetch, lacking_jars = self._plan_updates(
+            update_queue, latest
+        )
+
+        # find out how big everything is, and what we already know about
+        # its contents
+        self.print_status("Checking file sizes...")
+        with self.phase("lookup"):
+            pool = WorkerPool(self.jobs)
+            sizes = {}
+            size_errors = {}
+            results = pool.imap_unordered(
+                lambda item: self._head_size(item[1].download_url),
+                files_to_fetch
+            )
+            for (data, f), size, error in results:
+                sizes[f.download_url] = size
+                if error is not None:
+                    size_errors[f.download_url] = str(error)
+
+        entries = []
         for data, f in files_to_fetch:
-            n += 1
-            fn = self.download(
-                file=f, into=plugins_dir, file_num=n, total_files=file_count,
-                fn=data['filename']
+            digests = None
+            if self.store is not None:
+                digests = self.store.lookup(f.download_url)
+            entries.append({
+                'server_mod_id': data['server_mod_id'],
+                'server_mod_name': data['server_mod_name'],
+                'filename': data['filename'],
+                'from_version': data['file_version'],
+                'file_version': f.name,
+                'file_name': f.file_name,
+                'release_type': f.release_type,
+                'game_version': f.game_version,
+                'download_url': f.download_url,
+                'size': sizes.get(f.download_url),
+                # as opposed to the server just not saying how big it is
+                'size_error': size_errors.get(f.download_url),
+                'md5': f.md5 or (digests['md5'] if digests else None),
+                'digest': primary_digest(digests) if digests else None,
+            })
+
+        plan = {
+            'version': self.PLAN_VERSION,
+            'created': time.time(),
+            'plugins_dir': plugins_dir,
+            'files': entries,
+        }
+        with open(args.output, 'w') as f:
+            json.dump(plan, f, indent=2, sort_keys=True)
+
+        total = sum(e['size'] or 0 for e in entries)
+        print("Planned {0} updates ({1} KiB), {2} up to date, "
+              "{3} lacking JARs".format(
+                  len(entries), total // 1024, len(up_to_date),
+                  len(lacking_jars)
+              ))
+        for e in entries:
+            extra = ""
+            if e['size_error'] is not None:
+                extra = " [couldn't check its size: {0}]".format(
+                    e['size_error']
+                )
+            print(" - {0} ({1} --> {2}){3}".format(
+                e['server_mod_name'], e['from_version'], e['file_version'],
+                extra
+            ))
+        print("Run 'apply --plan {0}' to carry it out".format(args.output))
+
+    def cmd_apply(self, args):
+        with open(args.plan, 'r') as f:
+            plan = json.load(f)
+        if plan.get('version') != self.PLAN_VERSION:
+            self.parser.error("I don't understand that plan's version")
+
+        plugins_dir = plan['plugins_dir']
+        if not os.path.isdir(plugins_dir):
+            self.parser.error("The folder " + plugins_dir +
+                              " from that plan doesn't exist any more")
+
+        self.print_status("Loading persistent storage...")
+        with self.phase("storage load"):
+            storage = self._get_storage(plugins_dir)
+        installed = storage.get_data()
+
+        fetches = []
+        for e in plan['files']:
+            current = installed.get(str(e['server_mod_id']))
+            if current is not None and \
+                    current['download_url'] == e['download_url']:
+                continue  # already applied
+            mod = ServerMod(self.api, e['server_mod_id'],
+                            name=e['server_mod_name'])
+            f = ServerModFile(
+                self.api, file_name=e['file_name'], name=e['file_version'],
+                release_type=e['release_type'],
+                download_url=e['download_url'],
+                game_version=e['game_version'],
+                project_id=e['server_mod_id'], md5=e['md5'],
+                size=e['size'], digest=e['digest']
+            )
+            f.server_mod = mod
+            fetches.append((mod, f, e['filename']))
+
+        if len(fetches) == 0:
+            print("Nothing to do, that plan has already been applied")
+            return
+
+        with self.phase("download"):
+            failed = self.download_all(
+                fetches, into=plugins_dir, storage=storage
+            )
+
+        self.print_status("Cleaning up...")
+        with self.phase("save"):
+            storage.save()
+        print("Applied {0} of {1} updates".format(
+            len(fetches) - len(failed), len(fetches)
+        ))
+        self.report_failed_downloads(failed)
+
+    def constraints_for(self, plugins_dir):
+        return self.dir_constraints.get(plugins_dir, self.constraints)
+
+    def resolve_latest(self, constraints, project_ids):
+        """ The file each project should have under constraints. Without
+        any, that's just the newest JAR, which latest_files() can find
+        without keeping every listing around. """
+        if constraints.is_default():
+            return self.api.latest_files(
+                project_ids, extension=constraints.extension
+            )
+        return self.api.resolve(constraints, project_ids)
+
+    def _parse_manifest_line(self, line, manifest_dir):
+        """ A manifest line is a plugins directory, optionally followed by
+        game-version=, release-types= (comma separated) and pin=ID=VERSION
+        settings for just that directory """
+        import shlex
+        words = shlex.split(line)
+        plugins_dir = os.path.abspath(os.path.join(manifest_dir, words[0]))
+        options = {'pins': {}}
+        for word in words[1:]:
+            key, sep, value = word.partition('=')
+            if key == 'game-version':
+                options['game_version'] = value
+            elif key == 'release-types':
+                options['release_types'] = value.split(',')
+            elif key == 'pin':
+                options['pins'].update(parse_pins([value]))
+            else:
+                raise ValueError("unknown manifest setting: " + word)
+        if len(words) > 1:
+            self.dir_constraints[plugins_dir] = self.constraints.merged(
+                **options
+            )
+        return plugins_dir
+
+    def _get_fleet_dirs(self, args):
+        plugins_dirs = list(args.plugins_dirs)
+        if args.manifest is not None:
+            manifest_dir = os.path.dirname(os.path.abspath(args.manifest))
+            with open(args.manifest, 'r') as f:
+                for line in f:
+                    line = line.strip()
+                    if line == '' or line.startswith('#'):
+                        continue
+                    try:
+                        plugins_dirs.append(
+                            self._parse_manifest_line(line, manifest_dir)
+                        )
+                    except ValueError as e:
+                        self.parser.error("{0}: {1}".format(
+                            args.manifest, e
+                        ))
+
+        if len(plugins_dirs) == 0:
+            self.parser.error(
+                "Tell me which plugins directories to update, either on " +
+                "the command line or with --manifest"
+            )
+
+        canonical_dirs = []
+        for plugins_dir in plugins_dirs:
+            plugins_dir = os.path.abspath(plugins_dir)
+            if not os.path.isdir(plugins_dir):
+                self.parser.error("The folder " + plugins_dir +
+                                  " doesn't exist or is not a folder.")
+            if plugins_dir not in canonical_dirs:
+                canonical_dirs.append(plugins_dir)
+        return canonical_dirs
+
+    def cmd_fleet_update(self, args):
+        plugins_dirs = self._get_fleet_dirs(args)
+
+        self.print_status("Loading persistent storage...")
+        storages = {}
+        with self.phase("storage load"):
+            for plugins_dir in plugins_dirs:
+                storages[plugins_dir] = self._get_storage(plugins_dir)
+
+        self.print_status("Checking installed plugins...")
+        project_ids = set()
+        for storage in storages.values():
+            with self.phase("recheck"):
+                storage.recheck()
+            self.report_recheck(storage)
+            with self.phase("save"):
+                storage.save()
+            project_ids.update(storage.get_data().keys())
+
+        if len(project_ids) == 0:
+            self.parser.error("You don't have anything to update yet!")
+
+        # directories with the same constraints share one resolution
+        profiles = {}  # constraints key -> (constraints, project IDs)
+        for plugins_dir in plugins_dirs:
+            constraints = self.constraints_for(plugins_dir)
+            profile = profiles.setdefault(
+                constraints.key(), (constraints, set())
+            )
+            profile[1].update(storages[plugins_dir].get_data().keys())
+
+        self.print_status("Checking for updates...")
+        resolved = {}
+        with self.phase("lookup"):
+            if len(profiles) == 1:
+                for key, (constraints, profile_ids) in profiles.items():
+                    resolved[key] = self.resolve_latest(
+                        constraints, sorted(profile_ids)
+                    )
+            else:
+                # one batched lookup, which every profile then resolves from
+                self.api.files(project_ids=sorted(project_ids))
+                for key, (constraints, profile_ids) in profiles.items():
+                    resolved[key] = self.api.resolve(
+                        constraints, sorted(profile_ids)
+                    )
+
+        # work out which distinct files need to go where
+        artifacts = {}  # download URL -> (file, [(plugins_dir, data)])
+        counts = {}
+        for plugins_dir in plugins_dirs:
+            latest = resolved[self.constraints_for(plugins_dir).key()]
+            up_to_date, files_to_fetch, lacking_jars = self._plan_updates(
+                storages[plugins_dir].get_data(), latest
+            )
+            counts[plugins_dir] = (
+                len(files_to_fetch), len(up_to_date), len(lacking_jars)
+            )
+            for data, f in files_to_fetch:
+                if f.download_url not in artifacts:
+                    artifacts[f.download_url] = (f, [])
+                artifacts[f.download_url][1].append((plugins_dir, data))
+
+        print("Summary:                ")
+        for plugins_dir in plugins_dirs:
+            print(" {0}: {1} to update, {2} up to date, {3} lacking JARs"
+                  .format(plugins_dir, *counts[plugins_dir]))
+        if len(profiles) > 1:
+            print(" ({0} different sets of constraints)".format(
+                len(profiles)
+            ))
+        print("")
+
+        if len(artifacts) == 0:
+            return
+
+        print(" Going to download")
+        for f, targets in artifacts.values():
+            print(" - {0}: {1} (into {2} folders)".format(
+                f.server_mod.name, f.name, len(targets)
+            ))
+        print("")
+
+        ok = self.await_ok()
+        if not ok:
+            return
+
+        if self.store is not None:
+            for plugins_dir in plugins_dirs:
+                self.store.register(plugins_dir)
+
+        for plugins_dir in plugins_dirs:
+            self.keep_replaced(plugins_dir, storages[plugins_dir], [
+                f for f, targets in artifacts.values()
+                if plugins_dir in [z for z, data in targets]
+            ])
+
+        progress = DownloadProgress(self, len(artifacts))
+        pool = WorkerPool(self.jobs)
+
+        def fetch(item):
+            # download into the first folder, and copy it to the others;
+            # returns the digests, the targets the file got put into and
+            # (plugins_dir, error) for those it didn't
+            f, targets = item
+            first_dir, first_data = targets[0]
+            fn, digests = self.fetch_file(
+                f, into=first_dir, fn=first_data['filename'],
+                progress=progress
             )
-            storage.installed(mod=mod, file=f, filename=fn)
+            src = os.path.join(first_dir, fn)
+            placed = [(first_dir, first_data)]
+            errors = []
+            for plugins_dir, data in targets[1:]:
+                try:
+                    place_file(
+                        src, os.path.join(plugins_dir, data['filename']),
+                        self.link_method
+                    )
+                except (OSError, IOError) as e:
+                    errors.append((plugins_dir, e))
+                else:
+                    placed.append((plugins_dir, data))
+            return digests, placed, errors
+
+        failed = []
+        with self.phase("download"):
+            results = pool.imap_unordered(fetch, artifacts.values())
+            for (f, targets), result, error in results:
+                progress.finished(f)
+                if error is not None:
+                    failed.append((f.server_mod, error))
+                    continue
+                digests, placed, errors = result
+                for plugins_dir, data in placed:
+                    storages[plugins_dir].installed(
+                        mod=f.server_mod, file=f, filename=data['filename'],
+                        digests=digests
+                    )
+                for plugins_dir, e in errors:
+                    failed.append((f.server_mod, "{0} in {1}".format(
+                        e, plugins_dir
+                    )))
+            print("")
 
         self.print_status("Cleaning up...")
+        with self.phase("save"):
+            for storage in storages.values():
+                storage.save()
+        self.report_failed_downloads(failed)
+
+    def cmd_watch(self, args):
+        plugins_dir = self.canonicalise_plugins_dir(args)
+
+        # every poll should at least revalidate the file listings
+        if self.api.cache is None:
+            self.api.cache = MemoryResponseCache()
+        self.api.cache.ttls['/files'] = 0
+
+        if self.store is None and (args.stage or args.install):
+            self.store = ArtifactStore(
+                os.path.join(plugins_dir, '.servermods-store'),
+                link_method=self.link_method
+            )
+
+        watcher = UpdateWatcher(
+            self, plugins_dir, interval=args.interval, jitter=args.jitter,
+            stage=args.stage, install=args.install
+        )
+
+        def print_event(event):
+            print(json.dumps(event, sort_keys=True))
+            sys.stdout.flush()
+        watcher.add_hook(print_event)
+
+        if args.hook is not None:
+            def run_hook(event):
+                import subprocess
+                p = subprocess.Popen(args.hook, shell=True,
+                                     stdin=subprocess.PIPE)
+                p.communicate(json.dumps(event).encode('utf-8'))
+            watcher.add_hook(run_hook)
+
+        try:
+            watcher.run(count=args.count)
+        except KeyboardInterrupt:
+            pass
+
+    def cmd_rollback(self, args):
+        plugins_dir = self.canonicalise_plugins_dir(args)
+        storage = self._get_storage(plugins_dir)
+        history = self._get_history(plugins_dir)
+
+        if args.list:
+            for snapshot in history.snapshots():
+                print(" - {0}: {1} (replaced {2})".format(
+                    snapshot['server_mod_name'], snapshot['file_version'],
+                    format_time(snapshot['replaced'])
+                ))
+            return
+
+        if len(args.mods) == 0:
+            self.parser.error("Tell me which server mods to roll back!")
+
+        installed = storage.get_data()
+        rollbacks = []
+        unknown = []
+        for name in args.mods:
+            snapshots = [
+                z for z in history.snapshots()
+                if name.lower() in (
+                    str(z['server_mod_id']),
+                    z['server_mod_name'].lower(),
+                    os.path.splitext(z['filename'])[0].lower()
+                )
+            ]
+            current = installed.get(
+                str(snapshots[0]['server_mod_id'])
+            ) if snapshots else None
+            # the newest version that isn't the one we've got now
+            snapshots = [
+                z for z in snapshots if current is None or
+                history.digest(z) != history.digest(current)
+            ]
+            if len(snapshots) == 0:
+                unknown.append(name)
+            else:
+                rollbacks.append((snapshots[0], current))
+        if len(unknown) > 0:
+            self.parser.error(
+                'There\'s nothing to roll back to for: "' +
+                '", "'.join(unknown) + '"'
+            )
+
+        # which means the current versions can be rolled forward again,
+        # without making room by evicting the ones we're rolling back to
+        history.snapshot(plugins_dir, [
+            current for snapshot, current in rollbacks if current is not None
+        ], protect=[history.digest(snapshot) for snapshot, _ in rollbacks])
+        for snapshot, current in rollbacks:
+            data = dict(snapshot)
+            del data['replaced']
+            if current is not None:
+                data['filename'] = current['filename']
+            history.restore(snapshot, os.path.join(
+                plugins_dir, data['filename']
+            ))
+            storage.record(data)
+            print("Rolled {0} back to {1}".format(
+                data['server_mod_name'], data['file_version']
+            ))
         storage.save()
 
+    def cmd_store_gc(self, args):
+        if self.store is None:
+            self.parser.error("You need to tell me where your --store is!")
+
+        self.print_status("Collecting garbage...")
+        removed, freed = self.store.gc()
+        print("Removed {0} files from the store, freeing {1} KiB".format(
+            removed, freed // 1024
+        ))
+
 
 if __name__ == '__main__':
     clc = CommandLineClient()
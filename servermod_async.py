@@ -0,0 +1,154 @@
+"""
+asyncio flavour of the Server Mods API client.
+
+This lives in its own module because it needs Python 3.5+ syntax, while
+servermod.py itself still runs on Python 2.
+"""
+import asyncio
+
+try:
+    import aiohttp
+except ImportError:
+    raise Exception(
+        "Please install the aiohttp module to use AsyncServerModAPI."
+    )
+
+from servermod import (
+    ServerMod, ServerModAPI, ServerModFile, FileCatalog, APIErrorException,
+    NoSuchFile
+)
+
+
+class AsyncServerMod(ServerMod):
+    async def files(self):
+        if self._files is not None:
+            return self._files
+
+        files = await self.api.files(project_id=self.id)
+        for f in files:
+            f.server_mod = self  # add a back reference
+
+        self._files = files
+
+        return files
+
+    async def latest_file(self, **kwargs):
+        await self.files()  # make sure they're fetched, with back references
+
+        f = self.api.catalog(self.id).latest_file(**kwargs)
+        if f is None:
+            raise NoSuchFile()
+
+        return f
+
+
+class AsyncServerModAPI(object):
+    base_url = ServerModAPI.base_url
+    who_am_i = ServerModAPI.who_am_i
+    max_connections = 10
+
+    def __init__(self, api_key, who_am_i=None, max_connections=None,
+                 session=None):
+        self.api_key = api_key
+        if who_am_i is not None:
+            self.who_am_i = who_am_i
+        if max_connections is not None:
+            self.max_connections = max_connections
+        self.file_cache = {}
+        self.catalogs = {}
+        self.client = session
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    def _get_client(self):
+        # the session has to be created from within a running event loop
+        if self.client is None:
+            self.client = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_connections),
+                headers={
+                    'X-API-Key': self.api_key,
+                    'User-Agent': self.who_am_i
+                }
+            )
+        return self.client
+
+    async def close(self):
+        if self.client is not None:
+            await self.client.close()
+            self.client = None
+
+    def build_url(self, url):
+        return self.base_url + url
+
+    async def get(self, url, query={}):
+        async with self._get_client().get(url, params=query) as r:
+            r.raise_for_status()
+            data = await r.json(content_type=None)
+
+        if 'errorCode' in data:
+            raise APIErrorException(data)
+
+        return data
+
+    catalog = ServerModAPI.catalog
+
+    async def projects(self, search):
+        query = {
+            'search': search
+        }
+        url = self.build_url("/projects")
+        return [
+            AsyncServerMod.from_json(self, d)
+            for d in await self.get(url, query)
+        ]
+
+    async def projects_many(self, queries):
+        """ Runs several project searches at once, returning a dict of
+        query -> list of AsyncServerMod """
+        queries = list(queries)
+        results = await asyncio.gather(*[self.projects(q) for q in queries])
+        return dict(zip(queries, results))
+
+    async def files(self, project_id=None, project_ids=None):
+        if project_id is not None:
+            if int(project_id) in self.file_cache:
+                return self.file_cache[int(project_id)]
+
+            id_query = str(project_id)
+        elif project_ids is not None:
+            project_ids = list(project_ids)
+            id_query = ','.join([str(z) for z in project_ids])
+        else:
+            raise Exception(
+                "One of project_id or project_ids must be passed into files()"
+            )
+
+        if id_query == '':
+            return [] if project_id is not None else {}
+
+        query = {
+            'projectIds': id_query
+        }
+        url = self.build_url("/files")
+        files = [
+            ServerModFile.from_json(self, d)
+            for d in await self.get(url, query)
+        ]
+
+        # cache everything, projects without any files getting an (empty)
+        # entry too
+        requested = [project_id] if project_id is not None else project_ids
+        file_tree = dict((int(z), []) for z in requested)
+        for file in files:
+            file_tree.setdefault(file.project_id, []).append(file)
+        self.file_cache.update(file_tree)
+        for z, project_files in file_tree.items():
+            self.catalogs[z] = FileCatalog(project_files)
+
+        if project_id is not None:
+            return files  # plain project ID
+        return file_tree
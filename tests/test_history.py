@@ -0,0 +1,85 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from servermod import CLIStorage, CommandLineClient, ServerMod, ServerModFile
+
+
+class RollbackTest(unittest.TestCase):
+    history_size = 8000
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.mod = ServerMod(None, 1, slug='plugin0', name='Plugin 0')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def contents(self, version):
+        return ('plugin0 v{0} '.format(version) * 500)[:5000].encode('ascii')
+
+    def install(self, version):
+        """ Installs version the way download_all does """
+        client = CommandLineClient()
+        client.history_size = self.history_size
+        storage = CLIStorage(self.dir)
+        f = ServerModFile(
+            None, 'plugin0.jar', 'Plugin 0 v{0}'.format(version), 'release',
+            'http://example.com/{0}/plugin0.jar'.format(version),
+            'CB 1.7', 1
+        )
+        client.keep_replaced(self.dir, storage, [f])
+        # downloads replace files by renaming over them, which leaves the
+        # history's hardlinks to the old version alone
+        contents = self.contents(version)
+        tmp_path = os.path.join(self.dir, '.plugin0.jar.part')
+        with open(tmp_path, 'wb') as out:
+            out.write(contents)
+        os.rename(tmp_path, os.path.join(self.dir, 'plugin0.jar'))
+        storage.installed(mod=self.mod, file=f, filename='plugin0.jar',
+                          digests={
+                              'md5': hashlib.md5(contents).hexdigest(),
+                              'sha256': hashlib.sha256(contents).hexdigest(),
+                          })
+        storage.save()
+
+    def rollback(self, *argv):
+        CommandLineClient().run([
+            '--plugins-dir', self.dir, '--api-key', 'key',
+            '--history-size', str(self.history_size), 'rollback'
+        ] + list(argv))
+
+    def installed(self):
+        with open(os.path.join(self.dir, 'plugin0.jar'), 'rb') as f:
+            contents = f.read()
+        version = CLIStorage(self.dir).get_data()['1']['file_version']
+        return contents, version
+
+    def test_rollback_and_forward(self):
+        self.history_size = 1024 * 1024
+        self.install(0)
+        self.install(1)
+        self.rollback('plugin0')
+        self.assertEqual(self.installed(), (self.contents(0), 'Plugin 0 v0'))
+        self.rollback('plugin0')
+        self.assertEqual(self.installed(), (self.contents(1), 'Plugin 0 v1'))
+
+    def test_rollback_near_size_cap(self):
+        # the history only has room for one of the two versions, so keeping
+        # the current one mustn't evict the one being restored
+        self.install(0)
+        self.install(1)
+        self.rollback('plugin0')
+        self.assertEqual(self.installed(), (self.contents(0), 'Plugin 0 v0'))
+
+    def test_fresh_install_has_no_history(self):
+        self.install(0)
+        self.assertFalse(
+            os.path.exists(os.path.join(self.dir, '.servermods-history'))
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import json
+import unittest
+
+from servermod import APIErrorException, iter_json_array
+
+
+DOCUMENTS = [
+    '[]',
+    ' [ ] ',
+    '[1]',
+    '[1.5e3]',
+    '[-0.25E-2, 10, 1e+5, 0]',
+    '[true, false, null]',
+    '["a,b]", "\\"quoted\\"", "\\u00e9"]',
+    '[{"id": 1, "name": "plugin.jar"}, {"id": 22, "nested": [1.0, [2]]}]',
+    ' [ 1 , 2.5 ,\n"x" ] \n',
+]
+
+
+def split_every(doc, size):
+    return [doc[i:i + size] for i in range(0, len(doc), size)]
+
+
+class IterJSONArrayTest(unittest.TestCase):
+    def assertParses(self, doc, chunks):
+        self.assertEqual(
+            list(iter_json_array(chunks)), json.loads(doc),
+            "{0!r} split as {1!r}".format(doc, chunks)
+        )
+
+    def test_whole_document(self):
+        for doc in DOCUMENTS:
+            self.assertParses(doc, [doc])
+
+    def test_split_at_every_offset(self):
+        for doc in DOCUMENTS:
+            for i in range(len(doc) + 1):
+                self.assertParses(doc, [doc[:i], doc[i:]])
+
+    def test_every_chunk_size(self):
+        for doc in DOCUMENTS:
+            for size in range(1, len(doc) + 1):
+                self.assertParses(doc, split_every(doc, size))
+
+    def test_empty_chunks(self):
+        for doc in DOCUMENTS:
+            chunks = []
+            for c in doc:
+                chunks.extend(['', c])
+            self.assertParses(doc, chunks + [''])
+
+    def test_yields_before_the_end(self):
+        def chunks():
+            yield '[{"id": 1}, '
+            raise AssertionError("read past the first element")
+
+        self.assertEqual(next(iter_json_array(chunks())), {'id': 1})
+
+    def test_error_object(self):
+        doc = '{"errorCode": 403, "errorMessage": "Forbidden"}'
+        for size in range(1, len(doc) + 1):
+            with self.assertRaises(APIErrorException):
+                list(iter_json_array(split_every(doc, size)))
+
+    def test_truncated(self):
+        for doc in ['[', '[1', '[1,', '[1.5e', '[{"id": 1']:
+            for size in range(1, len(doc) + 1):
+                with self.assertRaises(ValueError):
+                    list(iter_json_array(split_every(doc, size)))
+
+    def test_malformed(self):
+        for doc in ['[1 2]', '[1]]', '{}', '[1.5.3]']:
+            with self.assertRaises(ValueError):
+                list(iter_json_array([doc]))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+import json
+import threading
+import unittest
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer  # Python 2
+
+try:
+    import requests
+except ImportError:
+    requests = None
+
+from servermod import RequestScheduler, ServerModAPI
+
+
+class FlakyHandler(BaseHTTPRequestHandler):
+    """ Answers /files with a 503 for the first `failures` requests """
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests += 1
+            fail = server.requests <= server.failures
+        if fail:
+            body = b'{}'
+            self.send_response(503)
+            self.send_header('Retry-After', '0')
+        else:
+            body = json.dumps([{
+                'downloadUrl': 'http://example.com/a.jar',
+                'fileName': 'a.jar', 'gameVersion': 'CB 1.7',
+                'name': 'A v1', 'projectId': 1, 'releaseType': 'release',
+            }]).encode('utf-8')
+            self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@unittest.skipIf(requests is None, "needs the requests module")
+class StreamedRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.server = HTTPServer(('127.0.0.1', 0), FlakyHandler)
+        self.server.lock = threading.Lock()
+        self.server.requests = 0
+        self.server.failures = 0
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def make_api(self):
+        api = ServerModAPI(
+            'key', jobs=1, pool_per_host=1,
+            scheduler=RequestScheduler(backoff=0, max_retries=4)
+        )
+        api.base_url = 'http://127.0.0.1:{0}/servermods'.format(
+            self.server.server_address[1]
+        )
+        return api
+
+    def run_with_timeout(self, func, timeout=10):
+        result = {}
+
+        def run():
+            result['value'] = func()
+        thread = threading.Thread(target=run)
+        thread.daemon = True
+        thread.start()
+        thread.join(timeout)
+        self.assertFalse(thread.is_alive(), "request hung")
+        return result['value']
+
+    def test_streamed_request_retries_on_503(self):
+        self.server.failures = 3
+        api = self.make_api()
+        files = self.run_with_timeout(lambda: list(api.iter_files([1])))
+        self.assertEqual([f.file_name for f in files], ['a.jar'])
+        self.assertEqual(self.server.requests, 4)
+
+    def test_streamed_requests_keep_working_after_retries(self):
+        api = self.make_api()
+        for _ in range(3):
+            self.server.requests = 0
+            self.server.failures = 2
+            files = self.run_with_timeout(lambda: list(api.iter_files([1])))
+            self.assertEqual(len(files), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from servermod import CLIStorage
+
+
+def entry(server_mod_id, version):
+    return {
+        'server_mod_id': server_mod_id,
+        'server_mod_name': 'Plugin {0}'.format(server_mod_id),
+        'filename': 'plugin{0}.jar'.format(server_mod_id),
+        'file_version': 'v{0}'.format(version),
+        'download_url': 'http://example.com/{0}/{1}.jar'.format(
+            server_mod_id, version
+        ),
+        'hash': '0' * 32,
+        'size': 1,
+    }
+
+
+class JournalTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.dir, '.servermods.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def installed(self):
+        return dict(
+            (z, data['file_version'])
+            for z, data in CLIStorage(self.dir).get_data().items()
+        )
+
+    def test_replays_unsaved_changes(self):
+        storage = CLIStorage(self.dir)
+        storage.record(entry(1, 1))
+        storage.record(entry(2, 1))
+        storage.record(entry(1, 2))
+        storage.flush_journal()
+        self.assertEqual(self.installed(), {'1': 'v2', '2': 'v1'})
+
+    def test_save_removes_journal(self):
+        storage = CLIStorage(self.dir)
+        storage.record(entry(1, 1))
+        storage.save()
+        self.assertFalse(os.path.exists(self.journal_path))
+        self.assertEqual(self.installed(), {'1': 'v1'})
+
+    def test_torn_tail_then_appends(self):
+        storage = CLIStorage(self.dir)
+        storage.record(entry(1, 1))
+        storage.flush_journal()
+        # crash halfway through writing a line
+        with open(self.journal_path, 'a') as f:
+            f.write(json.dumps({'op': 'installed', 'id': '2'})[:20])
+
+        storage = CLIStorage(self.dir)
+        storage.record(entry(3, 1))
+        storage.record(entry(4, 1))
+        storage.flush_journal()
+        self.assertEqual(self.installed(), {'1': 'v1', '3': 'v1', '4': 'v1'})
+
+    def test_many_changes_are_batched(self):
+        storage = CLIStorage(self.dir)
+        for z in range(500):
+            storage.record(entry(z, 1))
+        storage.flush_journal()
+        with open(self.journal_path, 'r') as f:
+            self.assertEqual(len(f.readlines()), 500)
+        self.assertEqual(len(self.installed()), 500)
+
+
+class HashIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.storage = CLIStorage(self.dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, filename, contents):
+        path = os.path.join(self.dir, filename)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        return os.stat(path)
+
+    def index(self):
+        return sorted(
+            (fn, digest)
+            for fn, digest in self.storage.data['hash_index'].values()
+        )
+
+    def test_record_replaces_previous_contents(self):
+        self.storage.record_hash('a.jar', self.write('a.jar', b'1'), 'one')
+        self.storage.record_hash('b.jar', self.write('b.jar', b'22'), 'two')
+        self.storage.record_hash('a.jar', self.write('a.jar', b'333'), 'new')
+        self.assertEqual(self.index(), [('a.jar', 'new'), ('b.jar', 'two')])
+
+    def test_renamed_file_keeps_its_hash(self):
+        self.write('a.jar', b'contents')
+        digest = self.storage.get_hash('a.jar')
+        self.storage.record_hash('b.jar', self.write('b.jar', b'x'), 'old')
+        os.remove(os.path.join(self.dir, 'b.jar'))
+        os.rename(os.path.join(self.dir, 'a.jar'),
+                  os.path.join(self.dir, 'b.jar'))
+        self.assertEqual(self.storage.get_hash('b.jar'), digest)
+        self.assertEqual(self.index(), [('b.jar', digest)])
+
+    def test_recheck_forgets_missing_files(self):
+        self.storage.record_hash('a.jar', self.write('a.jar', b'1'), 'one')
+        self.storage.record_hash('b.jar', self.write('b.jar', b'22'), 'two')
+        os.remove(os.path.join(self.dir, 'a.jar'))
+        self.storage.recheck()
+        self.assertEqual(self.index(), [('b.jar', 'two')])
+        self.storage.record_hash('a.jar', self.write('a.jar', b'1'), 'one')
+        self.assertEqual(self.index(), [('a.jar', 'one'), ('b.jar', 'two')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,73 @@
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+
+from servermod import ArtifactStore, CLIStorage, primary_digest
+
+
+class ArtifactStoreGCTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = ArtifactStore(os.path.join(self.tmp, 'store'))
+        self.plugins_dir = os.path.join(self.tmp, 'plugins')
+        os.mkdir(self.plugins_dir)
+        self.store.register(self.plugins_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def add(self, name, contents):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as f:
+            f.write(contents)
+        digests = {
+            'md5': hashlib.md5(contents).hexdigest(),
+            'sha256': hashlib.sha256(contents).hexdigest(),
+        }
+        url = 'http://example.com/' + name
+        self.store.add(path, url, digests)
+        os.remove(path)
+        return url, digests
+
+    def entry(self, server_mod_id, url, digests):
+        return {
+            'server_mod_id': server_mod_id,
+            'server_mod_name': 'Plugin {0}'.format(server_mod_id),
+            'filename': 'plugin{0}.jar'.format(server_mod_id),
+            'file_version': 'v1',
+            'download_url': url,
+            'hash': digests['md5'],
+            'digest': primary_digest(digests),
+        }
+
+    def test_removes_unreferenced_objects(self):
+        url, digests = self.add('a.jar', b'a' * 100)
+        storage = CLIStorage(self.plugins_dir)
+        storage.record(self.entry(1, url, digests))
+        storage.save()
+        self.add('b.jar', b'b' * 200)
+
+        self.assertEqual(self.store.gc(), (1, 200))
+        self.assertEqual(self.store.lookup(url), digests)
+        self.assertIsNone(self.store.lookup('http://example.com/b.jar'))
+
+    def test_keeps_objects_only_referenced_from_the_journal(self):
+        # an install that was interrupted before it could save
+        url, digests = self.add('a.jar', b'a' * 100)
+        storage = CLIStorage(self.plugins_dir)
+        storage.record(self.entry(1, url, digests))
+        storage.flush_journal()
+
+        self.assertEqual(self.store.gc(), (0, 0))
+        self.assertEqual(self.store.lookup(url), digests)
+
+    def test_forgets_directories_that_have_gone(self):
+        self.add('a.jar', b'a' * 100)
+        shutil.rmtree(self.plugins_dir)
+        self.assertEqual(self.store.gc(), (1, 100))
+
+
+if __name__ == '__main__':
+    unittest.main()